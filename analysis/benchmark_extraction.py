@@ -0,0 +1,225 @@
+# Benchmark the extraction of the study definition against local synthetic
+# stores, broken down by variable family
+#
+# Usage (from the project root):
+#   python analysis/benchmark_extraction.py [--sizes 10000 100000] [--baseline PATH]
+#
+# For each population size a synthetic store is generated (see
+# synthetic_store.py) unless one of that size already exists in
+# BENCHMARK_DIR. Each variable family (FAMILIES, plus the JCVI variables of
+# grouping_variables.py and "other" for everything else) is then extracted on
+# its own with LocalBackend, together with the variables it depends on and the
+# population, in a fresh process so that its peak RSS is its own. The wall
+# time, rows read from the store and peak RSS of every family, and of the full
+# study, are written to RESULTS_FILE; with --baseline, they are also compared
+# with the results of a previous run. A family whose process fails, or does not
+# finish within --timeout seconds, stops the benchmark with an error naming the
+# family and population size.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Timing, memory and processes
+import multiprocessing
+import queue
+import resource
+import time
+
+## Results and paths
+import json
+import os
+import re
+
+## Study definition
+from cohortextractor.cohortextractor import load_study_definition
+import grouping_variables
+
+## Study definition planning
+from study_def_planner import dependency_graph, nested_names
+
+## Local backend
+from local_backend import CHUNK_SIZE, LocalBackend
+from synthetic_store import generate_store
+
+# Files
+
+BENCHMARK_DIR = "output/benchmark"
+RESULTS_FILE = "output/benchmark/extraction_benchmark.json"
+
+POPULATION_SIZES = [10000, 100000]
+
+# Seconds a family may take to extract before its process is stopped
+FAMILY_TIMEOUT = 4 * 60 * 60
+
+# Seconds between checks that the process of a family is still running
+POLL_INTERVAL = 5
+
+# Variable families, by the first pattern their (possibly tmp_) names match
+FAMILIES = {
+    "exposures": r"(tmp_)?exp_",
+    "diabetes_outcomes": r"(tmp_)?out_\w*(dm|hba1c|insulin|antidiabetic|diabetes|nonmetform)",
+    "mental_health_outcomes": r"(tmp_)?out_",
+    "covariates": r"(tmp_)?cov_",
+    "qa": r"qa_",
+}
+
+
+def variable_families(covariate_definitions: dict, jcvi_names: set) -> dict:
+    """
+    dictionary of family: names of the variables in the family, with the
+    JCVI variables (`jcvi_names`) as their own family
+    """
+    families = {family: [] for family in ["jcvi", *FAMILIES, "other"]}
+    for name in covariate_definitions:
+        if name in jcvi_names:
+            families["jcvi"].append(name)
+            continue
+        family = next((family for family, pattern in FAMILIES.items() if re.match(pattern, name)), "other")
+        families[family].append(name)
+    return families
+
+
+def with_dependencies(covariate_definitions: dict, names: list) -> dict:
+    """
+    the definitions of the variables in `names`, the variables they depend on
+    and the population, in the order they are defined
+    """
+    graph = dependency_graph(covariate_definitions)
+    needed, pending = set(), [*names, "population"]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(graph[name])
+    return {name: definition for name, definition in covariate_definitions.items() if name in needed}
+
+
+def benchmark_family(store: str, covariate_definitions: dict, chunk_size: int, results):
+    """
+    extract the variables in `covariate_definitions` from `store`, putting
+    the wall time, rows read and peak RSS on the `results` queue (run in a
+    child process, whose RSS starts from that of its parent)
+    """
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    backend = LocalBackend(store, covariate_definitions, chunk_size)
+    df = backend.to_dataframe()
+    results.put({
+        "wall_time_seconds": round(time.perf_counter() - start, 3),
+        "rows_scanned": backend.rows_scanned,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "baseline_rss_bytes": baseline_rss,
+        "output_rows": len(df),
+    })
+
+
+def run_in_process(store: str, covariate_definitions: dict, chunk_size: int, size: int, family: str, timeout: float) -> dict:
+    """
+    benchmark_family() in a forked process, raising a RuntimeError naming
+    the population `size` and `family` if the process fails or has not
+    finished within `timeout` seconds
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=benchmark_family, args=(store, covariate_definitions, chunk_size, results))
+    process.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+            if time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"Benchmark of {family} for {size} patients did not finish within {timeout} seconds")
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError(f"Benchmark of {family} for {size} patients failed with exit code {process.exitcode}")
+    return result
+
+
+def benchmark_store(size: int, covariate_definitions: dict, seed: int) -> tuple:
+    """
+    path of the synthetic store of `size` patients, generating it if it
+    does not exist yet, and the time taken to generate it
+    """
+    path = os.path.join(BENCHMARK_DIR, f"synthetic_ehr_{size}.sqlite")
+    if os.path.exists(path):
+        return path, None
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    start = time.perf_counter()
+    generate_store(path + ".tmp", size, covariate_definitions, seed)
+    os.replace(path + ".tmp", path)
+    return path, round(time.perf_counter() - start, 3)
+
+
+def compare(results: dict, baseline: dict):
+    """
+    print the change in wall time, rows read and peak RSS of each family
+    from a previous run
+    """
+    print(f"{'size':>10} {'family':<24} {'time':>8} {'rows':>8} {'rss':>8}")
+    for size, families in results["sizes"].items():
+        for family, result in families["families"].items():
+            previous = baseline.get("sizes", {}).get(size, {}).get("families", {}).get(family)
+            if not previous:
+                continue
+            changes = [
+                result[key] / previous[key] if previous[key] else float("nan")
+                for key in ("wall_time_seconds", "rows_scanned", "peak_rss_bytes")
+            ]
+            print(f"{size:>10} {family:<24} " + " ".join(f"{change:>7.2f}x" for change in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=POPULATION_SIZES)
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--seed", type=int, default=123456)
+    parser.add_argument("--timeout", type=float, default=FAMILY_TIMEOUT, help="seconds allowed for each family")
+    args = parser.parse_args()
+
+    # Read before the results are written, which may replace it
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    study = load_study_definition("study_definition")
+    covariate_definitions = study.covariate_definitions
+    families = variable_families(covariate_definitions, set(nested_names(grouping_variables.jcvi_variables)))
+
+    results = {"chunk_size": args.chunk_size, "sizes": {}}
+    for size in args.sizes:
+        store, generation_time = benchmark_store(size, covariate_definitions, args.seed)
+        size_results = {"store": store, "generation_time_seconds": generation_time, "families": {}}
+        for family, names in families.items():
+            if not names:
+                continue
+            result = run_in_process(
+                store, with_dependencies(covariate_definitions, names), args.chunk_size, size, family, args.timeout
+            )
+            size_results["families"][family] = {"variables": len(names), **result}
+            print(size, family, result, flush=True)
+        result = run_in_process(store, covariate_definitions, args.chunk_size, size, "all", args.timeout)
+        size_results["families"]["all"] = {"variables": len(covariate_definitions), **result}
+        print(size, "all", result, flush=True)
+        results["sizes"][str(size)] = size_results
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Assign categories to the values of a numeric column by the ranges they fall
+# in, with one searchsorted call
+#
+# Bins are given as the half-open ranges [lower, upper) of their categories,
+# in order, where a value takes the category of the first range containing it
+# (so ranges may overlap or leave gaps, as the conditions of categorised_as
+# may), or the default category if none does. The edges of all the ranges
+# split the number line into segments each wholly inside or outside every
+# range, so the category of each segment is worked out once and a value's
+# category is that of its segment: np.searchsorted over the edges, however
+# many bins there are (e.g. 100 deprivation centiles rather than 100
+# predicates).
+#
+# expression_compiler.py recognises categorised_as dictionaries whose
+# conditions are ranges of one numeric column (deprivation ntiles, BMI groups,
+# age bands) and evaluates them as bins; study_def_helper_functions.py writes
+# such dictionaries with generate_bin_dictionary().
+
+# Import statements
+
+## Arrays
+import numpy as np
+
+
+class Bins:
+    """
+    categories of ranges of a numeric column: `ranges` is a list of
+    (lower, upper) bounds, with -inf or inf for open ends, and a value takes
+    the index of the first range containing it, or `len(ranges)` (the
+    default) if none does
+    """
+
+    def __init__(self, ranges: list):
+        edges = np.unique([bound for bounds in ranges for bound in bounds if np.isfinite(bound)]).astype(np.float64)
+        # Segment i runs from edge i - 1 to edge i, the first and last open ended
+        lowers = np.concatenate([[-np.inf], edges])
+        uppers = np.concatenate([edges, [np.inf]])
+        self.edges = edges
+        self.default = len(ranges)
+        self.segments = np.full(len(lowers), self.default, dtype=np.int64)
+        for segment, (segment_lower, segment_upper) in enumerate(zip(lowers, uppers)):
+            for index, (lower, upper) in enumerate(ranges):
+                if lower <= segment_lower and segment_upper <= upper:
+                    self.segments[segment] = index
+                    break
+
+    def assign(self, values: np.ndarray) -> np.ndarray:
+        """
+        index of the range of each value, or the default for values in none
+        of the ranges (including NaN)
+        """
+        indexes = self.segments[np.searchsorted(self.edges, values, side="right")]
+        if np.issubdtype(np.asarray(values).dtype, np.floating):
+            indexes[np.isnan(values)] = self.default
+        return indexes
@@ -0,0 +1,154 @@
+# Check that the planner's rewrites of the study definition (see
+# study_def_planner.py) do not change the extracted cohort or its dummy data
+#
+# Usage (from the project root):
+#   python analysis/synthetic_store.py --patients N
+#   python analysis/check_planner.py [--store PATH] [--expectations-population N]
+#
+# The study definition is extracted from a local synthetic store with
+# LocalBackend (see local_backend.py) twice: as planned, and as written with
+# --param unplanned=1, which skips the planner's rewrites (pruned prefix
+# codelists, shared and nested scans, flattened aggregates and hidden
+# intermediates). Every column of the planned extraction, which holds every
+# variable that is not hidden, must be present in the unplanned extraction with
+# the same values for the same patients.
+#
+# cohortextractor generates dummy data from the expectations of the variables,
+# which some rewrites would lose (e.g. date_of() takes its dummy dates from its
+# source), so dummy data is also generated for both study definitions. Each
+# column of the planned dummy data must have the same incidence, within
+# sampling error, and for dates the same range, to within DATE_TOLERANCE, as in
+# the unplanned dummy data. Mismatching columns are listed and the script exits
+# with an error.
+
+# Import statements
+
+## Command line arguments
+import argparse
+import sys
+
+## Data frames
+import numpy as np
+import pandas as pd
+
+## Study definition
+from cohortextractor.cohortextractor import load_study_definition
+
+## Local backend
+from local_backend import CHUNK_SIZE, LocalBackend
+from synthetic_store import STORE_FILE
+
+# Modules that build the study definition when imported, so they are imported
+# again for each study definition
+STUDY_MODULES = ["study_definition", "grouping_variables"]
+
+# Seed of the dummy data of both study definitions
+DUMMY_SEED = 123456
+
+# Standard errors by which the incidence of a column of dummy data may differ
+INCIDENCE_ERRORS = 4
+
+# Difference allowed between the earliest (or latest) dummy dates of a column
+DATE_TOLERANCE = pd.Timedelta(days=365)
+
+
+def load_study(params=()):
+    """
+    the study definition, with cohortextractor `params`
+    """
+    for module in STUDY_MODULES:
+        sys.modules.pop(module, None)
+    return load_study_definition("study_definition", params=params)
+
+
+def extract(study, store: str, chunk_size: int):
+    """
+    data frame of `study` extracted from `store`
+    """
+    return LocalBackend(store, study.covariate_definitions, chunk_size).to_dataframe()
+
+
+def dummy_data(study, population: int):
+    """
+    data frame of dummy data cohortextractor generates for `study` from its
+    expectations
+    """
+    np.random.seed(DUMMY_SEED)
+    return study.make_df_from_expectations(population)
+
+
+def incidence(values: pd.Series) -> float:
+    """
+    fraction of a column of dummy data that is not empty
+    """
+    if values.dtype == bool:
+        return values.mean()
+    if pd.api.types.is_numeric_dtype(values):
+        return (values.fillna(0) != 0).mean()
+    return (values.notna() & (values.astype(str) != "")).mean()
+
+
+def mismatched_columns(planned, unplanned) -> list:
+    """
+    columns of the `planned` extraction that are missing from, or differ
+    from, the `unplanned` extraction
+    """
+    if not planned["patient_id"].equals(unplanned["patient_id"]):
+        return ["patient_id"]
+    return [
+        name for name in planned.columns
+        if name not in unplanned.columns or not planned[name].equals(unplanned[name])
+    ]
+
+
+def mismatched_dummy_columns(planned, unplanned) -> list:
+    """
+    columns of the `planned` dummy data that are missing from the `unplanned`
+    dummy data, or whose incidence or range of dates differs from it
+    """
+    mismatched = []
+    for name in planned.columns:
+        if name not in unplanned.columns:
+            mismatched.append(name)
+            continue
+        expected = incidence(unplanned[name])
+        error = np.sqrt(2 * expected * (1 - expected) / len(planned))
+        if abs(incidence(planned[name]) - expected) > INCIDENCE_ERRORS * error:
+            mismatched.append(name)
+        elif pd.api.types.is_datetime64_any_dtype(planned[name]) and planned[name].notna().any():
+            if (
+                abs(planned[name].min() - unplanned[name].min()) > DATE_TOLERANCE
+                or abs(planned[name].max() - unplanned[name].max()) > DATE_TOLERANCE
+            ):
+                mismatched.append(name)
+    return mismatched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default=STORE_FILE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--expectations-population", type=int, default=10000)
+    args = parser.parse_args()
+
+    planned_study = load_study()
+    planned = extract(planned_study, args.store, args.chunk_size)
+    planned_dummy = dummy_data(planned_study, args.expectations_population)
+    unplanned_study = load_study(params={"unplanned": "1"})
+    unplanned = extract(unplanned_study, args.store, args.chunk_size)
+    unplanned_dummy = dummy_data(unplanned_study, args.expectations_population)
+
+    mismatched = mismatched_columns(planned, unplanned)
+    print(f"Compared {len(planned.columns)} columns for {len(planned)} patients")
+    mismatched_dummy = mismatched_dummy_columns(planned_dummy, unplanned_dummy)
+    print(f"Compared {len(planned_dummy.columns)} columns of dummy data for {len(planned_dummy)} patients")
+    if mismatched:
+        print("Planned extraction differs from the study definition as written in: " + ", ".join(mismatched))
+    if mismatched_dummy:
+        print("Planned dummy data differs from the study definition as written in: " + ", ".join(mismatched_dummy))
+    if mismatched or mismatched_dummy:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# Compiled cache of the codelists read by analysis/codelists.py
+#
+# codelist_from_csv() here is a drop-in replacement for the cohortextractor
+# function of the same name. Every codelist is parsed from its CSV once and
+# stored in a single compiled file, keyed on the sha recorded for the CSV in
+# codelists/codelists.json (if it has one) and the CSV's modification time and
+# size, so later imports load the codes instead of re-parsing the CSVs, and a
+# CSV edited locally is parsed again even though its recorded sha is unchanged.
+#
+# The compiled file is a pickle of the codes of each codelist, rather than a
+# memory-mapped file of sorted code arrays: cohortextractor builds its queries
+# from Python lists of codes (and of code, category pairs), so arrays would
+# have to be converted back to lists on every import, and a pickle loads those
+# lists directly. Codelists that are matched against arrays of codes are sorted
+# by the local backend where it needs them (see codelist_index.py).
+#
+# The cache is only written at exit by a run that parsed a codelist that was
+# missing from it or had changed, and never by an extraction from a real
+# database (DATABASE_URL set), so runs on the backend only read it. The cache
+# is only a speed-up: if it cannot be read or written the codelists are parsed
+# as usual.
+#
+# Codelists are also loaded lazily: codelist_from_csv() and combine_codelists()
+# return a codelist whose codes are only loaded the first time they are used,
+# so codelists no variable uses are never parsed. Constructing a
+# StudyDefinition still loads every codelist its variables use, as
+# cohortextractor builds the queries of all its variables (and the planner
+# compares and hashes definitions by their codes), so any run that imports
+# the study definition loads all of those. A run can report
+# the codelists in analysis/codelists.py that were used, and those that were
+# not, in TOUCHED_REPORT at exit (see report_touched_codelists()).
+
+# Import statements
+
+## Files
+import atexit
+import json
+import os
+import pickle
+import sys
+
+## Cohort extractor
+from cohortextractor import codelist_from_csv as parse_codelist_csv
+from cohortextractor import combine_codelists as combine_loaded_codelists
+from cohortextractor import codelist
+from cohortextractor.codelistlib import Codelist
+
+# Files, relative to the project root whatever the working directory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_FILE = os.path.join(ROOT, ".codelist_cache/compiled_codelists.pickle")
+CODELISTS_JSON = os.path.join(ROOT, "codelists/codelists.json")
+TOUCHED_REPORT = os.path.join(ROOT, "logs/touched_codelists.json")
+
+
+class LazyCodelist(Codelist):
+    """
+    codelist whose codes are loaded by `load()` the first time they are used
+    """
+
+    def __init__(self, load, system, has_categories):
+        super().__init__()
+        self.system = system
+        self.has_categories = has_categories
+        self.load = load
+
+    @property
+    def loaded(self) -> bool:
+        return self.load is None
+
+    def codes(self) -> list:
+        if self.load is not None:
+            load, self.load = self.load, None
+            list.extend(self, load())
+        return self
+
+    def __iter__(self):
+        return list.__iter__(self.codes())
+
+    def __reversed__(self):
+        return list.__reversed__(self.codes())
+
+    def __len__(self):
+        return list.__len__(self.codes())
+
+    def __getitem__(self, index):
+        return list.__getitem__(self.codes(), index)
+
+    def __contains__(self, code):
+        return list.__contains__(self.codes(), code)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCodelist):
+            other = other.codes()
+        return list.__eq__(self.codes(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return list.__repr__(self.codes())
+
+    def __reduce_ex__(self, protocol):
+        # Copies are ordinary codelists with the codes already loaded
+        return (codelist, (list(self.codes()), self.system, False))
+
+
+def project_path(filename: str) -> str:
+    """
+    path of a file relative to the project root
+    """
+    return os.path.relpath(os.path.abspath(filename), ROOT)
+
+
+def load_shas(path: str) -> dict:
+    """
+    dictionary of codelist file path: sha from codelists.json
+    """
+    try:
+        with open(path) as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    directory = os.path.dirname(path)
+    return {os.path.join(directory, filename): entry.get("sha") for filename, entry in files.items()}
+
+
+def load_cache(path: str) -> dict:
+    """
+    compiled codelists from a previous run, or an empty cache
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return {}
+
+
+def save_cache(path: str):
+    """
+    write the compiled codelists, including those parsed in this run
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def file_version(filename: str):
+    """
+    version of a codelist CSV: its sha from codelists.json (None for local
+    codelists), modification time and size
+    """
+    status = os.stat(filename)
+    return (shas.get(project_path(filename)), status.st_mtime_ns, status.st_size)
+
+
+def load_codelist_csv(filename, system, column, category_column) -> list:
+    """
+    codes of a codelist CSV, from the compiled cache when the CSV has not
+    changed since it was compiled
+    """
+    key = (project_path(filename), system, column, category_column)
+    version = file_version(filename)
+    if key in cache and cache[key][0] == version:
+        return cache[key][1]
+    codes = list(parse_codelist_csv(filename, system, column=column, category_column=category_column))
+    cache[key] = (version, codes)
+    if not parsed and not os.environ.get("DATABASE_URL"):
+        # The cache has changed, so write it at exit (unless extracting from a database)
+        atexit.register(save_cache, CACHE_FILE)
+    parsed.add(key)
+    return codes
+
+
+def codelist_from_csv(filename, system, column="code", category_column=None):
+    """
+    codelist_from_csv() from cohortextractor, loaded from the compiled cache
+    the first time the codes are used
+    """
+    return LazyCodelist(
+        lambda: load_codelist_csv(filename, system, column, category_column),
+        system,
+        has_categories=category_column is not None,
+    )
+
+
+def combine_codelists(first_codelist, *other_codelists):
+    """
+    combine_codelists() from cohortextractor, combined the first time the
+    codes are used
+    """
+    return LazyCodelist(
+        lambda: list(combine_loaded_codelists(first_codelist, *other_codelists)),
+        first_codelist.system,
+        has_categories=first_codelist.has_categories,
+    )
+
+
+def touched_codelists(namespace: dict) -> dict:
+    """
+    names of the lazy codelists in a module namespace whose codes were used,
+    and of those that were not
+    """
+    lazy = {name: value for name, value in namespace.items() if isinstance(value, LazyCodelist)}
+    return {
+        "touched": sorted(name for name, value in lazy.items() if value.loaded),
+        "untouched": sorted(name for name, value in lazy.items() if not value.loaded),
+    }
+
+
+def report_touched_codelists(path: str = TOUCHED_REPORT):
+    """
+    write which codelists from analysis/codelists.py were used to `path` when
+    the run exits
+    """
+    atexit.register(write_touched_report, path)
+
+
+def write_touched_report(path: str):
+    """
+    write which codelists from analysis/codelists.py were used in this run
+    """
+    module = sys.modules.get("codelists")
+    if module is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(touched_codelists(vars(module)), f, indent=2)
+    except OSError:
+        pass
+
+
+shas = {project_path(path): sha for path, sha in load_shas(CODELISTS_JSON).items()}
+cache = load_cache(CACHE_FILE)
+parsed = set()
@@ -0,0 +1,355 @@
+# Index of the codelists each code belongs to, for classifying coded events
+# against every codelist in analysis/codelists.py in a single pass
+#
+# The codes of each coding system are interned into a dense integer vocabulary
+# (ids 0..n-1), looked up with a static perfect hash, so event codes
+# can be held as int32 ids and codelist membership is an array lookup.
+#
+# Codelists of numeric codes, such as the large dm+d medication codelists, can
+# also be held as sorted int64 arrays and matched against a column of numeric
+# codes with a vectorised binary search. A column of codes matched against
+# several such codelists is reduced to its distinct values first, so each
+# codelist is only searched for the distinct codes, and a NumericCodelistIndex
+# only classifies the events whose code is not a number through the bitsets.
+#
+# ICD-10 (and OPCS-4) codelists for hospital admissions are matched by prefix:
+# a codelist entry such as the category I21 matches any recorded code that
+# starts with it (I210, I211, ...). Entries with a shorter prefix in the same
+# codelist are redundant and can be pruned, and a PrefixIndex classifies a
+# recorded code by looking up each of its prefixes, so every diagnosis position
+# of every admission is matched against all the codelists in one pass.
+#
+# Each code id maps to a bitset with one bit per codelist (in words of 64
+# bits). Classifying a column of event codes encodes every code once and
+# returns the bitsets of the events, from which the events in any codelist are
+# a single bit test. Running one filter per codelist instead would scan the
+# events once for each of the ~160 codelists.
+
+# Import statements
+
+## Arrays
+import numpy as np
+
+
+def codelist_codes(codelist) -> set:
+    """
+    codes in a codelist, without any categories
+    """
+    return {item[0] if isinstance(item, tuple) else item for item in codelist}
+
+
+def hash_codes(codes: np.ndarray, seed: int) -> np.ndarray:
+    """
+    vectorised FNV-1a hash of an array of fixed-width byte strings
+    """
+    data = codes.view(np.uint8).reshape(len(codes), codes.itemsize)
+    hashes = np.full(len(codes), np.uint64(14695981039346656037) ^ np.uint64(seed), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in data.T:
+            hashes ^= column
+            hashes *= np.uint64(1099511628211)
+    return hashes
+
+
+def next_prime(number: int) -> int:
+    """
+    smallest prime number no less than `number`
+    """
+    candidate = max(number, 2)
+    while any(candidate % divisor == 0 for divisor in range(2, int(candidate ** 0.5) + 1)):
+        candidate += 1
+    return candidate
+
+
+class CodeVocabulary:
+    """
+    dense integer ids for the codes of one coding system, looked up with a
+    static perfect hash (hash and displace): each code is hashed to a bucket,
+    and every bucket has a displacement chosen when the vocabulary is built so
+    that its codes land in distinct slots of a table of a prime number of
+    slots (at most a few more than there are codes), so that every
+    displacement step moves a code to a different slot
+    """
+
+    def __init__(self, codes):
+        self.codes = np.array(sorted(set(codes)), dtype=bytes)
+        self.buckets = max(len(self.codes) // 4, 1)
+        size = next_prime(len(self.codes))
+        while not self.place(size):
+            size = next_prime(size + 1)
+
+    def place(self, size: int) -> bool:
+        """
+        choose the displacements of the buckets for a table of `size` slots,
+        or return False if some bucket's codes cannot be placed in distinct
+        free slots
+        """
+        self.displacements = np.zeros(self.buckets, dtype=np.uint64)
+        self.slots = np.full(size, -1, dtype=np.int32)
+
+        bucket, first, second = self.hashes(self.codes)
+        taken = np.zeros(size, dtype=bool)
+        order = np.argsort(bucket, kind="stable")
+        starts = np.searchsorted(bucket[order], np.arange(self.buckets + 1))
+        members = [order[starts[b]:starts[b + 1]] for b in range(self.buckets)]
+        # Place the largest buckets first, while most slots are still free
+        for b in sorted(range(self.buckets), key=lambda b: -len(members[b])):
+            ids = members[b]
+            if len(ids) == 0:
+                continue
+            displacement = 0
+            while True:
+                # Every displacement up to size * size gives a different set of slots
+                if displacement >= size * size:
+                    return False
+                candidates = np.arange(displacement, displacement + 1024, dtype=np.uint64)
+                slots = (first[ids][None, :] + candidates[:, None] * second[ids][None, :] + candidates[:, None] // np.uint64(size)) % np.uint64(size)
+                free = ~taken[slots].any(axis=1)
+                if len(ids) > 1:
+                    ordered = np.sort(slots, axis=1)
+                    free &= (ordered[:, 1:] != ordered[:, :-1]).all(axis=1)
+                if free.any():
+                    found = int(np.argmax(free))
+                    self.displacements[b] = candidates[found]
+                    taken[slots[found]] = True
+                    self.slots[slots[found].astype(np.int64)] = ids
+                    break
+                displacement += 1024
+        return True
+
+    def __len__(self):
+        return len(self.codes)
+
+    def hashes(self, codes: np.ndarray) -> tuple:
+        """
+        bucket and the two slot hashes of fixed-width codes
+        """
+        size = np.uint64(len(self.slots))
+        bucket = hash_codes(codes, 0) % np.uint64(self.buckets)
+        slot = hash_codes(codes, 1)
+        first = (slot & np.uint64(0xFFFFFFFF)) % size
+        # Never zero, so with a prime table size each step reaches a new slot
+        second = (slot >> np.uint64(32)) % (size - np.uint64(1)) + np.uint64(1)
+        return bucket.astype(np.int64), first, second
+
+    def encode(self, codes) -> np.ndarray:
+        """
+        int32 ids of `codes`, with -1 for codes not in the vocabulary
+        """
+        codes = np.asarray(codes, dtype=bytes)
+        if len(self.codes) == 0 or len(codes) == 0:
+            return np.full(len(codes), -1, dtype=np.int32)
+        if codes.itemsize > self.codes.itemsize:
+            # Codes longer than any in the vocabulary would be truncated to match
+            wide = codes.astype(f"S{self.codes.itemsize + 1}")
+            fits = wide.view(np.uint8).reshape(len(codes), -1)[:, -1] == 0
+        else:
+            fits = True
+        codes = codes.astype(self.codes.dtype)
+        size = np.uint64(len(self.slots))
+        bucket, first, second = self.hashes(codes)
+        displacement = self.displacements[bucket]
+        ids = self.slots[((first + displacement * second + displacement // size) % size).astype(np.int64)]
+        return np.where(fits & (ids >= 0) & (self.codes[ids] == codes), ids, -1).astype(np.int32)
+
+
+def is_numeric_code(code: str) -> bool:
+    """
+    whether a code is a number that an int64 holds exactly, with no leading
+    zeros (e.g. dm+d or SNOMED ids)
+    """
+    return code.isascii() and code.isdigit() and len(code) <= 18 and (code == "0" or code[0] != "0")
+
+
+def numeric_codes(codes) -> np.ndarray:
+    """
+    int64 values of an array of codes, with -1 for codes that are not numbers
+    (see is_numeric_code()), parsed digit by digit over the whole array
+    """
+    codes = np.asarray(codes, dtype=str)
+    chars = codes.view(np.uint32).reshape(len(codes), codes.dtype.itemsize // 4)
+    present = chars != 0
+    lengths = present.sum(axis=1)
+    digits = chars - np.uint32(ord("0"))
+    numeric = (
+        ((digits <= 9) | ~present).all(axis=1)
+        & (lengths > 0)
+        & (lengths <= 18)
+        & ((chars[:, 0] != ord("0")) | (lengths == 1))
+    )
+    values = np.zeros(len(codes), dtype=np.int64)
+    with np.errstate(over="ignore"):
+        for column in range(chars.shape[1]):
+            values = np.where(present[:, column], values * 10 + digits[:, column].astype(np.int64), values)
+    return np.where(numeric, values, -1)
+
+
+class SortedCodelist:
+    """
+    codes of a codelist that are numbers (e.g. dm+d ids) as a sorted int64
+    array
+    """
+
+    def __init__(self, codelist):
+        self.system = codelist.system
+        numbers = [int(code) for code in codelist_codes(codelist) if is_numeric_code(code)]
+        self.codes = np.unique(np.array(numbers, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def contains(self, codes) -> np.ndarray:
+        """
+        boolean mask of the numeric `codes` that are in the codelist
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        if len(self.codes) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        positions = np.searchsorted(self.codes, codes).clip(max=len(self.codes) - 1)
+        return self.codes[positions] == codes
+
+
+def match_sorted_codelists(codes, codelists: dict) -> dict:
+    """
+    dictionary of name: boolean mask of the numeric `codes` in each of the
+    SortedCodelists in `codelists`
+    """
+    distinct, inverse = np.unique(np.asarray(codes, dtype=np.int64), return_inverse=True)
+    return {name: codelist.contains(distinct)[inverse] for name, codelist in codelists.items()}
+
+
+class CodelistIndex:
+    """
+    bitsets of the codelists of one coding system that each code belongs to
+    """
+
+    def __init__(self, codelists: dict, system: str):
+        members = {
+            name: codelist_codes(codelist)
+            for name, codelist in codelists.items()
+            if codelist.system == system
+        }
+        self.system = system
+        self.names = list(members)
+        self.vocabulary = CodeVocabulary(set().union(*members.values()))
+        self.bitsets = np.zeros((len(self.vocabulary), (len(self.names) + 63) // 64), dtype=np.uint64)
+        for position, codes in enumerate(members.values()):
+            ids = self.vocabulary.encode(sorted(codes))
+            self.bitsets[ids, position // 64] |= np.uint64(1) << np.uint64(position % 64)
+
+    def classify(self, codes) -> np.ndarray:
+        """
+        bitsets of the codelists that each of `codes` (or int32 code ids from
+        the vocabulary) belongs to, with no bits set for codes that are in
+        none of them
+        """
+        codes = np.asarray(codes)
+        ids = codes if codes.dtype.kind == "i" else self.vocabulary.encode(codes)
+        found = ids >= 0
+        bitsets = np.zeros((len(ids), self.bitsets.shape[1]), dtype=np.uint64)
+        bitsets[found] = self.bitsets[ids[found]]
+        return bitsets
+
+    def classify_positions(self, codes) -> np.ndarray:
+        """
+        bitsets of the codelists matched by any of the codes recorded against
+        each row of a 2-d array (e.g. one row per admission and one column per
+        diagnosis position, with empty strings for unused positions)
+        """
+        codes = np.asarray(codes, dtype=bytes)
+        rows, positions = codes.shape
+        bitsets = self.classify(codes.reshape(-1)).reshape(rows, positions, -1)
+        return np.bitwise_or.reduce(bitsets, axis=1)
+
+    def members(self, bitsets: np.ndarray, name: str) -> np.ndarray:
+        """
+        boolean mask of the classified codes that are in codelist `name`
+        """
+        position = self.names.index(name)
+        word = bitsets[:, position // 64] >> np.uint64(position % 64)
+        return (word & np.uint64(1)).astype(bool)
+
+
+class NumericCodelistIndex:
+    """
+    codelists of one coding system whose codes are mostly numbers (e.g. the
+    dm+d medication codelists): the numeric codes of each codelist are
+    searched as a SortedCodelist, and only the events whose code is not a
+    number are classified through a CodelistIndex of the other codes
+    """
+
+    def __init__(self, codelists: dict, system: str):
+        codelists = {name: codelist for name, codelist in codelists.items() if codelist.system == system}
+        self.system = system
+        self.names = list(codelists)
+        self.sorted = {name: SortedCodelist(codelist) for name, codelist in codelists.items()}
+        others = {}
+        for name, codelist in codelists.items():
+            codes = [code for code in codelist_codes(codelist) if not is_numeric_code(code)]
+            if codes:
+                others[name] = type(codelist)(codes)
+                others[name].system = system
+        self.index = CodelistIndex(others, system)
+
+    def classify_positions(self, codes) -> dict:
+        """
+        dictionary of name: boolean mask of the rows of a 2-d array of codes
+        (as for CodelistIndex.classify_positions()) with a code in each
+        codelist
+        """
+        codes = np.asarray(codes, dtype=str)
+        numbers = numeric_codes(codes.reshape(-1))
+        masks = {
+            name: mask.reshape(codes.shape).any(axis=1)
+            for name, mask in match_sorted_codelists(numbers, self.sorted).items()
+        }
+        others = ((numbers < 0).reshape(codes.shape) & (codes != "")).any(axis=1)
+        if self.index.names and others.any():
+            bitsets = self.index.classify_positions(codes[others])
+            for name in self.index.names:
+                masks[name][others] |= self.index.members(bitsets, name)
+        return masks
+
+    def members(self, masks: dict, name: str) -> np.ndarray:
+        """
+        boolean mask of the classified rows that are in codelist `name`
+        """
+        return masks[name]
+
+
+def prune_prefix_codes(codes) -> list:
+    """
+    sorted codes of a prefix-matched codelist without the codes that start
+    with another code in the codelist, which match nothing more (e.g. I210
+    when the codelist also has I21)
+    """
+    codes = set(codes)
+    return sorted(
+        code for code in codes
+        if not any(code[:length] in codes for length in range(1, len(code)))
+    )
+
+
+class PrefixIndex(CodelistIndex):
+    """
+    bitsets of the prefix-matched codelists (e.g. ICD-10 diagnoses) of one
+    coding system that each recorded code matches, through any of its prefixes
+    """
+
+    def __init__(self, codelists: dict, system: str):
+        super().__init__(codelists, system)
+        self.lengths = sorted({len(code) for code in self.vocabulary.codes})
+
+    def classify(self, codes) -> np.ndarray:
+        """
+        bitsets of the codelists with an entry that is a prefix of each of
+        `codes` (recorded codes, not code ids)
+        """
+        codes = np.asarray(codes, dtype=bytes)
+        bitsets = np.zeros((len(codes), self.bitsets.shape[1]), dtype=np.uint64)
+        for length in self.lengths:
+            # Codes shorter than `length` are matched at their own length
+            ids = self.vocabulary.encode(codes.astype(f"S{length}"))
+            found = ids >= 0
+            bitsets[found] |= self.bitsets[ids[found]]
+        return bitsets
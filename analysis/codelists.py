@@ -1,4 +1,7 @@
-from cohortextractor import codelist_from_csv, combine_codelists, codelist
+from cohortextractor import codelist
+
+# Codelists are loaded lazily through a compiled cache of the CSVs (see codelist_cache.py)
+from codelist_cache import codelist_from_csv, combine_codelists
 
 # COVID RELATED CODELISTS ---------------------------------------------------------------------------------
 
@@ -885,17 +885,14 @@ def generate_common_variables(index_date_variable):
             returning="category",
             find_last_match_in_period=True,
         ),
-        cov_ethnicity_gp_opensafely_date=patients.with_these_clinical_events(
-            opensafely_ethnicity_codes_6,
-            on_or_before=f"{index_date_variable}",
-            returning="category",
-            find_last_match_in_period=True,
+        ## Dates of the same last matches, from the category queries above
+        cov_ethnicity_gp_opensafely_date=patients.date_of(
+            "cov_ethnicity_gp_opensafely",
+            date_format="YYYY-MM-DD",
         ),
-        cov_ethnicity_gp_primis_date=patients.with_these_clinical_events(
-            primis_covid19_vacc_update_ethnicity,
-            on_or_before=f"{index_date_variable}",
-            returning="category",
-            find_last_match_in_period=True,
+        cov_ethnicity_gp_primis_date=patients.date_of(
+            "cov_ethnicity_gp_primis",
+            date_format="YYYY-MM-DD",
         ),
         return_expectations=helpers.generate_universal_expectations(5,True),
     ),
@@ -0,0 +1,401 @@
+# Generate dummy data for the study definition from its return_expectations,
+# as a columnar NumPy engine
+#
+# Usage (from the project root):
+#   python analysis/dummy_data.py [--population 100000] [--output output/dummy_input.feather] [--validate]
+#   python analysis/dummy_data.py --variables cov_num_bmi [...]
+#
+# With --validate the file is checked against the study definition as
+# cohortextractor generate_cohort --dummy-data-file checks it. cohortextractor
+# itself cannot check this study's dummy data, as it needs a date format for
+# minimum_of/maximum_of dates, which the study definition does not record; the
+# formats the TPP backend gives them (that of their first column) are derived
+# here for the check instead (see aggregate_date_formats()).
+#
+# The dummy data follow the expectations framework of cohortextractor
+# (StudyDefinition.make_df_from_expectations()): dates are uniform or
+# exponentially increasing between the earliest and latest expected dates and
+# limited to the variable's window, values are normal or poisson ints, normal
+# floats, categories in the expected ratios (e.g. those from
+# study_def_helper_functions.generate_universal_expectations()) or flags, a
+# fraction 1 - incidence of each column is empty, and the values of a variable
+# with a date of match are empty wherever its date is. minimum_of/maximum_of
+# aggregate their source columns, generated from their own expectations when
+# they are hidden.
+#
+# Each column is generated with one vectorised call per distribution rather
+# than row by row through pandas and scipy, from its own random stream, so the
+# columns are generated in parallel (dates first, then the values that match
+# their incidence) and the result does not depend on the number of workers.
+# A variable's stream is derived from the seed and its name alone (not from a
+# global NumPy seed), so a column is bit-identical across runs whatever else
+# the study defines, and --variables regenerates just the columns whose
+# definitions changed in an existing dummy data file.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Parallel columns
+from concurrent.futures import ThreadPoolExecutor
+
+## Files and hashes
+import functools
+import hashlib
+import os
+from pathlib import Path
+
+## Arrays and data frames
+import numpy as np
+import pandas as pd
+
+## Cohort extractor
+from cohortextractor.cohortextractor import load_study_definition
+import cohortextractor
+from cohortextractor.pandas_utils import dataframe_to_file
+from cohortextractor.study_definition import StudyDefinition, merge
+from cohortextractor.validate_dummy_data import validate_dummy_data
+
+## Date truncation as in the TPP backend
+from local_backend import truncate_dates
+
+# Files
+
+DUMMY_FILE = "output/dummy_input.feather"
+
+POPULATION_SIZE = 100000
+
+# Query types whose columns are computed from other columns rather than
+# generated from expectations
+COMPUTED_QUERIES = {"aggregate_of", "fixed_value"}
+
+# Values of the rows of a column that are made empty to match its incidence
+EMPTY_VALUES = {"bool": 0, "int": 0, "float": 0.0}
+
+# UK population by 5-year age band, for the population_ages distribution
+POPULATION_BANDS = os.path.join(os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv")
+
+
+@functools.lru_cache()
+def population_age_probabilities(max_age=110) -> np.ndarray:
+    """
+    probability of each age from 0 to `max_age` - 1 in the UK population, as
+    in cohortextractor.expectation_generators.generate_ages()
+    """
+    bands = pd.read_csv(POPULATION_BANDS, thousands=",")
+    ends = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    counts = bands["range"].to_numpy()
+    band = np.searchsorted(ends, np.arange(max_age))
+    probabilities = counts[band] / counts.sum() / 5
+    # Make the probabilities add up to 1 by trimming the largest
+    probabilities[np.argmax(probabilities)] -= probabilities.sum() - 1
+    return probabilities
+
+
+def column_expectations(study, args: dict) -> dict:
+    """
+    the default expectations of the study merged with those of a variable (or,
+    for the date of a match, those of the variable it is the date of)
+    """
+    if args["funcname"] == "value_from" and args["column_type"] == "date":
+        args = study.covariate_definitions[args["source"]][1]
+    return merge(study.default_expectations, args.get("return_expectations") or {})
+
+
+def generate_dates(rng, size: int, earliest: str, latest: str, rate: str) -> np.ndarray:
+    """
+    dates between `earliest` and `latest`, uniform or increasingly common
+    towards `latest` (an exponential distribution truncated to the range)
+    """
+    low, high = np.datetime64(earliest, "D"), np.datetime64(latest, "D")
+    elapsed = int((high - low).astype(int))
+    if rate == "uniform":
+        fraction = rng.random(size)
+    elif rate == "exponential_increase":
+        fraction = -0.1 * np.log1p(-rng.random(size) * (1 - np.exp(-10)))
+    else:
+        raise ValueError("Only exponential_increase and uniform distributions currently supported")
+    return high - (fraction * elapsed).astype(np.int64)
+
+
+def empty_rows(rng, size: int, incidence) -> np.ndarray:
+    """
+    boolean mask of exactly int((1 - incidence) * size) random rows
+    """
+    count = int((1 - incidence) * size)
+    # Sample whichever of the empty and the kept rows are fewer
+    if count <= size // 2:
+        empty = np.zeros(size, dtype=bool)
+        empty[rng.choice(size, count, replace=False, shuffle=False)] = True
+    else:
+        empty = np.ones(size, dtype=bool)
+        empty[rng.choice(size, size - count, replace=False, shuffle=False)] = False
+    return empty
+
+
+def generate_date_column(rng, study, args: dict, size: int) -> np.ndarray:
+    """
+    datetime64[D] dates of a date variable, NaT where empty or outside the
+    variable's window
+    """
+    expectations = column_expectations(study, args)
+    study.check_date_expectations_defined(args["name"], expectations)
+    rate = expectations.get("rate", "exponential_increase")
+    dates = generate_dates(rng, size, expectations["date"]["earliest"], expectations["date"]["latest"], rate)
+    if rate != "universal":
+        dates[empty_rows(rng, size, expectations["incidence"])] = np.datetime64("NaT")
+    min_date, max_date = StudyDefinition.filter_date_range(args.get("between"))
+    if min_date:
+        dates[dates < np.datetime64(min_date, "D")] = np.datetime64("NaT")
+    if max_date:
+        dates[dates > np.datetime64(max_date, "D")] = np.datetime64("NaT")
+    return dates
+
+
+def generate_value_column(rng, study, args: dict, dtype: str, size: int, match_dates=None):
+    """
+    values of a variable from its expectations: ints, floats, flags or the
+    codes of categories (with -1 for empty), and the categories
+    """
+    expectations = column_expectations(study, args)
+    rate = expectations.pop("rate", "exponential_increase")
+    if dtype == "category":
+        study.validate_category_expectations(**args)
+        ratios = expectations["category"]["ratios"]
+        categories = list(ratios)
+        values = rng.choice(len(categories), size=size, p=np.array(list(ratios.values())) / sum(ratios.values()))
+        empty = -1
+    elif dtype == "Int64":
+        distribution = expectations["int"]
+        if distribution["distribution"] == "normal":
+            values = rng.normal(distribution["mean"], distribution["stddev"], size=size).astype(np.int64)
+        elif distribution["distribution"] == "poisson":
+            values = rng.poisson(distribution["mean"], size=size)
+        elif distribution["distribution"] == "population_ages":
+            probabilities = population_age_probabilities()
+            values = rng.choice(len(probabilities), size=size, p=probabilities)
+        else:
+            raise ValueError(
+                "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+            )
+        categories, empty = None, EMPTY_VALUES["int"]
+    elif dtype == "float":
+        distribution = expectations["float"]
+        if distribution["distribution"] != "normal":
+            raise ValueError("Only `normal` distributions currently supported for floats")
+        values = rng.normal(distribution["mean"], distribution["stddev"], size=size)
+        categories, empty = None, EMPTY_VALUES["float"]
+    elif dtype == "bool":
+        values = np.ones(size, dtype=np.int64)
+        categories, empty = None, EMPTY_VALUES["bool"]
+    else:
+        raise ValueError(f"Unable to generate dummy data of type {dtype} for {args['name']}")
+
+    if match_dates is not None:
+        values[np.isnat(match_dates)] = empty
+    elif rate != "universal":
+        values[empty_rows(rng, size, expectations["incidence"])] = empty
+    return values, categories
+
+
+def output_column(args: dict, values, categories=None) -> pd.Series:
+    """
+    a generated column converted to the type cohortextractor gives it in an
+    extraction (see cohortextractor.pandas_utils.get_pandas_convertor())
+    """
+    if categories is not None:
+        # Categories in order of first appearance, as pandas_utils.Categoriser
+        order = pd.unique(values[values >= 0])
+        recoded = np.full(len(categories), -1, dtype=np.int64)
+        recoded[order] = np.arange(len(order))
+        codes = np.where(values >= 0, recoded[values.clip(0)], -1)
+        labels = [categories[code] for code in order]
+        if args["column_type"] == "date":
+            # Dates from categorised_as are generated as categories
+            dates = np.array(labels + [None], dtype="datetime64[D]")
+            return pd.Series(dates[codes].astype("datetime64[ns]"))
+        return pd.Series(pd.Categorical.from_codes(codes, categories=labels))
+    if args["column_type"] == "date":
+        return pd.Series(values.astype("datetime64[ns]"))
+    if args["column_type"] == "bool":
+        return pd.Series(values.astype(bool))
+    return pd.Series(values)
+
+
+def aggregate_column(columns: dict, args: dict) -> np.ndarray:
+    """
+    minimum or maximum of the generated source columns of an aggregate,
+    ignoring empty values (as the TPP backend does, for every column type)
+    """
+    values = np.stack([columns[name] for name in args["column_names"]])
+    reduce = np.fmin if args["aggregate_function"] == "MIN" else np.fmax
+    if args["column_type"] == "date":
+        return reduce.reduce(values, axis=0)
+    empty = EMPTY_VALUES[args["column_type"]]
+    result = reduce.reduce(np.where(values == empty, np.nan, values.astype(np.float64)), axis=0)
+    return np.where(np.isnan(result), empty, result).astype(values.dtype)
+
+
+def variable_stream(seed: int, name: str) -> np.random.SeedSequence:
+    """
+    random stream of a variable, derived from the seed and the variable's name
+    alone, so it does not depend on the other variables or their order
+    """
+    key = int.from_bytes(hashlib.sha256(name.encode()).digest()[:16], "little")
+    return np.random.SeedSequence(seed, spawn_key=(key,))
+
+
+def generate_dummy_data(study, population: int, seed=123456, workers=None, variables=None) -> pd.DataFrame:
+    """
+    dummy data for the output columns of a study (or only those in
+    `variables`, and the aggregates of them), from their expectations
+    """
+    csv_args = study.pandas_csv_args
+    definitions = {
+        name: dict(query_args, funcname=query_type, name=name)
+        for name, (query_type, query_args) in study.covariate_definitions.items()
+        if name != "population"
+    }
+    output = [name for name in definitions if name in csv_args["args"]]
+    if variables is not None:
+        output = [
+            name for name in output
+            if name in variables or set(definitions[name].get("column_names") or []) & set(variables)
+        ]
+    # Hidden columns only need generating as sources of aggregates
+    sources = {
+        source for name in output if definitions[name]["funcname"] == "aggregate_of"
+        for source in definitions[name]["column_names"]
+    }
+    generated = [
+        name for name in definitions
+        if (name in output or name in sources) and definitions[name]["funcname"] not in COMPUTED_QUERIES
+    ]
+    date_col_for = {
+        args["source"]: name for name, args in definitions.items()
+        if args["funcname"] == "value_from" and args["column_type"] == "date"
+    }
+    # Values whose incidence matches their date of match need the date too
+    generated.extend(date_col_for[name] for name in list(generated) if date_col_for.get(name) not in (None, *generated))
+    dates = {
+        name for name in generated
+        if definitions[name]["column_type"] == "date" and not (
+            definitions[name]["funcname"] == "categorised_as"
+        )
+    }
+
+    def date_column(name):
+        rng = np.random.default_rng(variable_stream(seed, name))
+        return generate_date_column(rng, study, definitions[name], population)
+
+    def value_column(name):
+        args = definitions[name]
+        if args.get("returning") in ("index_of_multiple_deprivation", "rural_urban_classification"):
+            dtype = "category"
+        else:
+            dtype = {"bool": "bool", "int": "Int64", "str": "category", "float": "float", "date": "category"}[args["column_type"]]
+        match_dates = columns.get(date_col_for.get(name))
+        rng = np.random.default_rng(variable_stream(seed, name))
+        return generate_value_column(rng, study, args, dtype, population, match_dates)
+
+    columns, categories = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Dates first, for the values whose incidence matches them
+        for name, values in zip(sorted(dates), executor.map(date_column, sorted(dates))):
+            columns[name] = values
+        values_names = [name for name in generated if name not in dates]
+        for name, (values, name_categories) in zip(values_names, executor.map(value_column, values_names)):
+            columns[name], categories[name] = values, name_categories
+
+    for name in output:
+        args = definitions[name]
+        if args["funcname"] == "fixed_value":
+            value = args["value"]
+            columns[name] = np.full(population, np.datetime64(value, "D") if args["column_type"] == "date" else value)
+        elif args["funcname"] == "aggregate_of":
+            columns[name] = aggregate_column(columns, args)
+
+    # Patient ids drawn from a range 10 times the population, as cohortextractor does
+    output_columns = {
+        "patient_id": pd.Series(
+            np.random.default_rng(variable_stream(seed, "patient_id")).choice(
+                population * 10, size=population, replace=False
+            )
+        )
+    }
+    for name in output:
+        args = definitions[name]
+        values = columns[name]
+        if name in dates or (args["funcname"] in COMPUTED_QUERIES and args["column_type"] == "date"):
+            values = truncate_dates(values, csv_args["args"][name].get("date_format"))
+        output_columns[name] = output_column(args, values, categories.get(name))
+    return pd.concat(output_columns, axis=1)
+
+
+def update_dummy_data(df: pd.DataFrame, columns: pd.DataFrame) -> pd.DataFrame:
+    """
+    previously generated dummy data with the regenerated `columns` replacing
+    (or added after) those of the same name
+    """
+    if not df["patient_id"].equals(columns["patient_id"]):
+        raise ValueError("Dummy data was generated for a different population or seed; regenerate it in full")
+    df = df.copy()
+    for name in columns.columns.drop("patient_id"):
+        df[name] = columns[name]
+    return df
+
+
+def aggregate_date_formats(covariate_definitions: dict) -> dict:
+    """
+    copy of processed covariate definitions (StudyDefinition.covariate_definitions)
+    with minimum_of/maximum_of dates given the date format of their first
+    column, which the TPP backend formats them with but does not record
+    """
+    def date_format(name):
+        query_type, query_args = covariate_definitions[name]
+        if query_type == "aggregate_of":
+            return date_format(query_args["column_names"][0])
+        return query_args.get("date_format")
+
+    return {
+        name: (
+            query_type,
+            dict(query_args, date_format=date_format(name))
+            if query_type == "aggregate_of" and query_args["column_type"] == "date"
+            else query_args,
+        )
+        for name, (query_type, query_args) in covariate_definitions.items()
+    }
+
+
+def validate_dummy_file(study, filename: str):
+    """
+    check a dummy data file against the study definition, as cohortextractor
+    generate_cohort --dummy-data-file does, raising DummyDataValidationError
+    if it does not match
+    """
+    validate_dummy_data(aggregate_date_formats(study.covariate_definitions), Path(filename))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--population", type=int, default=POPULATION_SIZE)
+    parser.add_argument("--output", default=DUMMY_FILE)
+    parser.add_argument("--seed", type=int, default=123456)
+    parser.add_argument("--workers", type=int, help="threads generating columns (default: one per CPU)")
+    parser.add_argument("--variables", nargs="+", help="regenerate only these columns of an existing --output")
+    parser.add_argument("--validate", action="store_true", help="check the file against the study definition")
+    args = parser.parse_args()
+
+    study = load_study_definition("study_definition")
+    df = generate_dummy_data(study, args.population, args.seed, args.workers, args.variables)
+    if args.variables:
+        df = update_dummy_data(pd.read_feather(args.output), df)
+    dataframe_to_file(df, args.output)
+    if args.validate:
+        validate_dummy_file(study, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,488 @@
+# Compile the expressions of categorised_as and satisfying variables to
+# vectorised NumPy kernels
+#
+# An expression (e.g. "cov_cat_sex = 'F' AND vax_jcvi_age_1 < 50" or
+# "index_of_multiple_deprivation >= 32844*1/10") is tokenised and validated by
+# cohortextractor.expressions, in the same limited SQL dialect and with the
+# same implicit comparisons with empty values ("some_date" meaning
+# "some_date != ''"), and parsed into a tree of nested tuples:
+#   ("or", left, right)       ("and", left, right)      ("not", operand)
+#   ("compare", op, left, right)  ("arithmetic", op, left, right)
+#   ("column", name)          ("literal", value)
+# The tree is then compiled into a kernel: a function of a dictionary of
+# column name: array that evaluates the whole expression with one NumPy
+# operation per node, with the semantics the expressions have in the SQL
+# Server queries of the TPP backend. The one place these differ from NumPy's is
+# integer division: SQL Server truncates the quotient of two integers towards
+# zero, where NumPy's // rounds it down, so integer quotients are computed on
+# the operands' magnitudes and given their sign afterwards.
+#
+# A dictionary of categories compiles to a kernel returning the first category
+# whose expression holds for each row, as the CASE expression of
+# categorised_as does: the expressions are evaluated in order as a decision
+# table, each only over the rows not yet assigned a category, so the JCVI
+# groups and eligibility dates cost less the more patients the early groups
+# take. Sub-expressions repeated across the expressions of a dictionary (e.g.
+# the same date comparison in several groups) are evaluated once per set of
+# rows and reused. When every expression is a range of the same numeric column
+# (deprivation ntiles, BMI groups) the dictionary is evaluated as bins
+# instead, with a single search over the range edges (see binning.py).
+#
+# Parsing is the expensive part, so the trees are kept in CACHE_FILE (at the
+# project root, whatever the working directory), keyed on the expression and
+# the empty values of its columns, and only new expressions are parsed in later
+# runs. The cache is only written at exit by a run that parsed new
+# expressions. Like the codelist cache, the cache is only a speed-up: if it
+# cannot be read or written expressions are parsed as usual.
+
+# Import statements
+
+## Files
+import atexit
+import os
+import pickle
+
+## Counting
+from collections import Counter
+
+## Arrays
+import numpy as np
+
+## Bins of numeric columns
+from binning import Bins
+
+## Cohort extractor
+import sqlparse
+from sqlparse import tokens as ttypes
+from cohortextractor.expressions import (
+    InvalidExpressionError,
+    UnknownColumnError,
+    filter_and_validate_tokens,
+    insert_implicit_comparisons,
+    validate_expression,
+)
+
+# Files, relative to the project root whatever the working directory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_FILE = os.path.join(ROOT, ".expression_cache/compiled_expressions.pickle")
+
+# Comparison operators of the dialect
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+def literal_value(token):
+    """
+    value of a number or string literal token
+    """
+    if token.ttype in ttypes.Literal.String:
+        return token.value[1:-1]
+    if token.ttype in ttypes.Number.Integer:
+        return int(token.value)
+    return float(token.value)
+
+
+class Parser:
+    """
+    recursive descent parser of the tokens of an expression into a tree
+    """
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise InvalidExpressionError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def accept(self, ttype, values) -> str:
+        token = self.peek()
+        if token is not None and token.ttype in ttype and token.value.upper() in values:
+            self.position += 1
+            return token.value.upper()
+        return None
+
+    def parse(self) -> tuple:
+        tree = self.parse_or()
+        if self.peek() is not None:
+            raise InvalidExpressionError(f"Unexpected token: {self.peek().value}")
+        return tree
+
+    def parse_or(self) -> tuple:
+        tree = self.parse_and()
+        while self.accept(ttypes.Keyword, ("OR",)):
+            tree = ("or", tree, self.parse_and())
+        return tree
+
+    def parse_and(self) -> tuple:
+        tree = self.parse_not()
+        while self.accept(ttypes.Keyword, ("AND",)):
+            tree = ("and", tree, self.parse_not())
+        return tree
+
+    def parse_not(self) -> tuple:
+        if self.accept(ttypes.Keyword, ("NOT",)):
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> tuple:
+        tree = self.parse_sum()
+        while True:
+            op = self.accept(ttypes.Comparison, COMPARISONS)
+            if op is None:
+                return tree
+            tree = ("compare", op, tree, self.parse_sum())
+
+    def parse_sum(self) -> tuple:
+        tree = self.parse_product()
+        while True:
+            op = self.accept(ttypes.Operator, ("+", "-"))
+            if op is None:
+                return tree
+            tree = ("arithmetic", op, tree, self.parse_product())
+
+    def parse_product(self) -> tuple:
+        tree = self.parse_operand()
+        while True:
+            op = self.accept(ttypes.Operator, ("*", "/"))
+            if op is None:
+                return tree
+            tree = ("arithmetic", op, tree, self.parse_operand())
+
+    def parse_operand(self) -> tuple:
+        token = self.next()
+        if token.ttype in ttypes.Punctuation and token.value == "(":
+            tree = self.parse_or()
+            if not self.accept(ttypes.Punctuation, (")",)):
+                raise InvalidExpressionError("Missing closing parenthesis")
+            return tree
+        if token.ttype in ttypes.Name:
+            return ("column", token.value)
+        if token.ttype in ttypes.Literal.String or token.ttype in ttypes.Number:
+            return ("literal", literal_value(token))
+        if token.ttype in ttypes.Operator and token.value == "-":
+            return ("arithmetic", "-", ("literal", 0), self.parse_operand())
+        raise InvalidExpressionError(f"Unexpected token: {token.value}")
+
+
+def parse_expression(expression: str, empty_values: dict) -> tuple:
+    """
+    tree of an expression over columns with the given empty values,
+    validated as by cohortextractor.expressions.format_expression()
+    """
+    tokens = sqlparse.parse(expression)[0].flatten()
+    tokens = filter_and_validate_tokens(tokens)
+    tokens = list(insert_implicit_comparisons(tokens, empty_values))
+    try:
+        validate_expression(tokens, empty_values)
+        return Parser(tokens).parse()
+    except InvalidExpressionError as e:
+        raise InvalidExpressionError(f"Invalid SQL expression: {expression}\nError: {e}")
+
+
+def column_names(tree: tuple) -> set:
+    """
+    names of the columns an expression tree refers to
+    """
+    if tree[0] == "column":
+        return {tree[1]}
+    if tree[0] == "literal":
+        return set()
+    return set().union(*(column_names(node) for node in tree[1:] if isinstance(node, tuple)))
+
+
+def is_text(values) -> bool:
+    return isinstance(values, str) or getattr(values, "dtype", None) == object
+
+
+def compare(op: str, left, right):
+    """
+    comparison of two operands, where every number sorts before every string
+    (SQL Server would instead fail on a string that is not a number)
+    """
+    if is_text(left) == is_text(right):
+        return COMPARISONS[op](left, right)
+    # Compare the storage classes instead, broadcast to the operands' shape
+    shape = np.broadcast(left, right).shape
+    return np.full(shape, COMPARISONS[op](int(is_text(left)), int(is_text(right))))
+
+
+def arithmetic(op: str, left, right):
+    """
+    arithmetic on two numeric operands, dividing integers as SQL Server does
+    (rounding towards zero)
+    """
+    if is_text(left) or is_text(right):
+        raise InvalidExpressionError("Arithmetic is only supported on numbers")
+    if op == "+":
+        return np.add(left, right)
+    if op == "-":
+        return np.subtract(left, right)
+    if op == "*":
+        return np.multiply(left, right)
+    if np.issubdtype(np.result_type(left, right), np.integer):
+        quotient = np.abs(left) // np.abs(right)
+        return np.where(np.sign(left) * np.sign(right) < 0, -quotient, quotient)
+    return np.true_divide(left, right)
+
+
+def repeated_subtrees(trees: list) -> list:
+    """
+    subtrees (other than columns and literals) occurring more than once in a
+    list of expression trees
+    """
+    counts = Counter()
+
+    def count(tree):
+        if tree[0] in ("column", "literal"):
+            return
+        counts[tree] += 1
+        for node in tree[1:]:
+            if isinstance(node, tuple):
+                count(node)
+
+    for tree in trees:
+        count(tree)
+    return [tree for tree, n in counts.items() if n > 1]
+
+
+def compile_tree(tree: tuple, shared: dict = None):
+    """
+    kernel evaluating an expression tree over a dictionary of columns, given
+    a memo of the subtrees in `shared` (subtree: key) evaluated so far
+    """
+    shared = shared or {}
+    evaluate = compile_node(tree, shared)
+    if tree not in shared:
+        return evaluate
+    key = shared[tree]
+
+    def memoised(columns, memo):
+        if key not in memo:
+            memo[key] = evaluate(columns, memo)
+        return memo[key]
+
+    return memoised
+
+
+def compile_node(tree: tuple, shared: dict):
+    """
+    kernel evaluating the root of an expression tree, with its operands
+    compiled by compile_tree()
+    """
+    kind = tree[0]
+    if kind == "column":
+        name = tree[1]
+        return lambda columns, memo: columns[name]
+    if kind == "literal":
+        value = tree[1]
+        return lambda columns, memo: value
+    if kind == "not":
+        operand = compile_tree(tree[1], shared)
+        return lambda columns, memo: np.logical_not(operand(columns, memo))
+    if kind in ("and", "or"):
+        left, right = compile_tree(tree[1], shared), compile_tree(tree[2], shared)
+        combine = np.logical_and if kind == "and" else np.logical_or
+        return lambda columns, memo: combine(left(columns, memo), right(columns, memo))
+    op, left, right = tree[1], compile_tree(tree[2], shared), compile_tree(tree[3], shared)
+    apply = compare if kind == "compare" else arithmetic
+    return lambda columns, memo: apply(op, left(columns, memo), right(columns, memo))
+
+
+def constant_value(tree: tuple):
+    """
+    value of an expression tree of number literals, or None if it refers to
+    columns or strings
+    """
+    if tree[0] == "literal":
+        return tree[1] if not isinstance(tree[1], str) else None
+    if tree[0] != "arithmetic":
+        return None
+    left, right = constant_value(tree[2]), constant_value(tree[3])
+    if left is None or right is None:
+        return None
+    return arithmetic(tree[1], left, right)
+
+
+def column_range(tree: tuple):
+    """
+    column and half-open range [lower, upper) of the values for which an
+    expression tree holds, if it is a conjunction of comparisons of one
+    column with numbers (e.g. "bmi >= 18.5 AND bmi < 25"), otherwise None
+    """
+    if tree[0] == "and":
+        left, right = column_range(tree[1]), column_range(tree[2])
+        if left is None or right is None or left[0] != right[0]:
+            return None
+        return left[0], max(left[1], right[1]), min(left[2], right[2])
+    if tree[0] != "compare" or tree[1] == "!=":
+        return None
+    op, left, right = tree[1:]
+    if right[0] == "column":
+        # Put the column on the left, e.g. 5 < x as x > 5
+        op, left, right = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "=": "="}[op], right, left
+    value = constant_value(right)
+    if left[0] != "column" or value is None:
+        return None
+    # Strict lower and inclusive upper bounds become the next value up
+    value = float(value)
+    after = np.nextafter(value, np.inf)
+    lower, upper = {
+        "=": (value, after), ">=": (value, np.inf), ">": (after, np.inf),
+        "<": (-np.inf, value), "<=": (-np.inf, after),
+    }[op]
+    return left[1], lower, upper
+
+
+def compile_bins(trees: list, empty_values: dict):
+    """
+    Bins evaluating the conditions of a dictionary of categories, and the
+    column they bin, if every condition is a range of the same numeric column
+    """
+    ranges = [column_range(tree) for tree in trees]
+    if not ranges or None in ranges:
+        return None
+    names = {name for name, lower, upper in ranges}
+    if len(names) != 1:
+        return None
+    name = names.pop()
+    if isinstance(empty_values.get(name), str):
+        return None
+    return Bins([(lower, upper) for _, lower, upper in ranges]), name
+
+
+def load_cache(path: str) -> dict:
+    """
+    parsed expressions from a previous run, or an empty cache
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return {}
+
+
+def save_cache(path: str):
+    """
+    write the parsed expressions, including those parsed in this run
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def expression_tree(expression: str, empty_values: dict) -> tuple:
+    """
+    tree of an expression, from the cache when it has been parsed before
+    with the same empty values
+    """
+    key = (expression, tuple(sorted(empty_values.items())))
+    if key not in cache:
+        if not parsed:
+            # The cache has changed, so write it at exit
+            atexit.register(save_cache, CACHE_FILE)
+        cache[key] = parse_expression(expression, empty_values)
+        parsed.add(key)
+    return cache[key]
+
+
+def first_matches(conditions: list, columns: dict, size: int) -> np.ndarray:
+    """
+    index of the first condition that holds for each row, or
+    len(conditions) if none does, evaluating the conditions in order as a
+    decision table: the columns are compacted to the rows still unassigned
+    whenever those fall to half of the rows being evaluated, so later
+    conditions only see the rows earlier ones did not match. Shared
+    sub-expressions are memoised, and compacted along with the columns.
+    """
+    default = len(conditions)
+    matches = np.full(size, default, dtype=np.int64)
+    # Matches of the rows being evaluated (all rows until the first compaction)
+    rows, evaluated = None, matches
+    unassigned = np.ones(size, dtype=bool)
+    memo = {}
+    for index, condition in enumerate(conditions):
+        matched = np.broadcast_to(condition(columns, memo), unassigned.shape).astype(bool) & unassigned
+        np.copyto(evaluated, index, where=matched)
+        unassigned ^= matched
+        remaining = np.count_nonzero(unassigned)
+        if not remaining:
+            break
+        if remaining <= len(unassigned) // 2:
+            kept = np.flatnonzero(unassigned)
+            if rows is not None:
+                matches[rows] = evaluated
+            rows = kept if rows is None else rows[kept]
+            columns = {name: values[kept] for name, values in columns.items()}
+            memo = {key: values[kept] if np.ndim(values) else values for key, values in memo.items()}
+            evaluated = np.full(remaining, default, dtype=np.int64)
+            unassigned = np.ones(remaining, dtype=bool)
+    if rows is not None:
+        matches[rows] = evaluated
+    return matches
+
+
+def compile_categories(category_definitions: dict, empty_values: dict):
+    """
+    kernel returning the category of each row from a dictionary of
+    category: expression, the first whose expression holds or the DEFAULT
+    category, and the names of the columns it uses. Ranges of a single
+    numeric column are evaluated as bins, anything else as a decision table
+    (see first_matches()).
+    """
+    key = (tuple(category_definitions.items()), tuple(sorted(empty_values.items())))
+    if key in kernels:
+        return kernels[key]
+    definitions = dict(category_definitions)
+    defaults = [category for category, expression in definitions.items() if expression == "DEFAULT"]
+    if len(defaults) != 1:
+        raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+    definitions.pop(defaults[0])
+    trees = [expression_tree(expression, empty_values) for expression in definitions.values()]
+    shared = {tree: key for key, tree in enumerate(repeated_subtrees(trees))}
+    conditions = [compile_tree(tree, shared) for tree in trees]
+    categories = np.empty(len(definitions) + 1, dtype=object)
+    categories[:] = [*definitions, defaults[0]]
+    names = set().union(*(column_names(tree) for tree in trees))
+    for name in names - set(empty_values):
+        raise UnknownColumnError(f"Unknown column: {name}")
+
+    binned = compile_bins(trees, empty_values)
+    if binned is not None:
+        bins, name = binned
+
+        def kernel(columns: dict, size: int) -> np.ndarray:
+            return categories[np.broadcast_to(bins.assign(columns[name]), (size,))]
+
+        kernels[key] = (kernel, names)
+        return kernels[key]
+
+    def kernel(columns: dict, size: int) -> np.ndarray:
+        return categories[first_matches(conditions, columns, size)]
+
+    kernels[key] = (kernel, names)
+    return kernels[key]
+
+
+cache = load_cache(CACHE_FILE)
+parsed = set()
+kernels = {}
@@ -0,0 +1,163 @@
+# Re-extract only the variables whose definitions have changed since the last
+# extraction, and merge them into output/input.feather
+#
+# Usage (from the project root):
+#   python analysis/extract_changed_variables.py (--expectations-population N | --store PATH)
+#
+# Supported backends: dummy data (--expectations-population) and a local
+# synthetic store (--store, extracted with extract_local.py). On the backend the
+# job runner runs cohortextractor itself, so the script cannot extract from a
+# database and exits with an error if DATABASE_URL is set.
+#
+# Each variable is hashed with its resolved codelist contents and window (see
+# study_def_planner.definition_hashes()), and the hashes of the extraction are
+# recorded in output/variable_hashes.json. A changed variable is extracted
+# again together with every variable that depends on it. Changes to the study
+# definition itself (index date, population, JCVI variables), a missing
+# previous extraction or a population that no longer matches the previous
+# extraction fall back to a full extraction.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Hashes and paths
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+## Data frames
+import pandas as pd
+
+## Study definition, imported by main() (see below)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Files
+
+COHORT_FILE = "output/input.feather"
+HASHES_FILE = "output/variable_hashes.json"
+CHANGED_DIR = "output/changed_variables"
+STUDY_FILES = ["analysis/study_definition.py", "analysis/grouping_variables.py"]
+
+
+def study_hashes(variable_hashes: dict) -> dict:
+    """
+    definition hashes of the dynamic variables, plus a hash of the study
+    definition files for everything that is not hashed per variable
+    """
+    hashes = dict(variable_hashes)
+    study = hashlib.sha256()
+    for path in STUDY_FILES:
+        with open(path, "rb") as f:
+            study.update(f.read())
+    hashes["study_definition"] = study.hexdigest()
+    return hashes
+
+
+def generate_cohort(output_dir: str, expectations_population=None, store=None, changed_since=None):
+    """
+    write input.feather to `output_dir`, with cohortextractor's dummy data of
+    `expectations_population` patients or extracted from a local `store`
+    """
+    if store:
+        os.makedirs(output_dir, exist_ok=True)
+        command = [
+            sys.executable, "analysis/extract_local.py",
+            "--store", store,
+            "--output", os.path.join(output_dir, "input.feather"),
+        ]
+    else:
+        command = [
+            "cohortextractor", "generate_cohort",
+            "--study-definition", "study_definition",
+            "--output-format", "feather",
+            "--output-dir", output_dir,
+            "--expectations-population", str(expectations_population),
+        ]
+    if changed_since:
+        command += ["--param", f"changed_since={changed_since}"]
+    subprocess.run(command, check=True)
+
+
+def merge_changed_columns(cohort_file: str, changed_file: str, covariate_definitions: dict, dummy_data: bool) -> bool:
+    """
+    replace the columns of `cohort_file` with those extracted again in
+    `changed_file`, matching rows on patient_id, and drop columns that are no
+    longer in `covariate_definitions`. Returns False, leaving `cohort_file`
+    unchanged, if the two files are not for the same patients.
+    """
+    cohort = pd.read_feather(cohort_file)
+    changed = pd.read_feather(changed_file)
+
+    if dummy_data:
+        # Dummy patients are redrawn on each run, so rows are matched by position
+        if len(changed) != len(cohort):
+            return False
+        changed["patient_id"] = cohort["patient_id"].values
+
+    cohort = cohort.set_index("patient_id")
+    changed = changed.set_index("patient_id")
+    if not cohort.index.sort_values().equals(changed.index.sort_values()):
+        return False
+    changed = changed.reindex(cohort.index)
+    for column in changed.columns:
+        cohort[column] = changed[column]
+
+    output_columns = [
+        name
+        for name, (query_type, query_args) in covariate_definitions.items()
+        if not query_args.get("hidden")
+    ]
+    cohort = cohort[[column for column in cohort.columns if column in output_columns]]
+    cohort.reset_index().to_feather(cohort_file)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--expectations-population", type=int)
+    source.add_argument("--store", help="local synthetic store (see synthetic_store.py)")
+    args = parser.parse_args()
+    if os.environ.get("DATABASE_URL"):
+        parser.error("only dummy data and local stores are supported; unset DATABASE_URL")
+
+    # Imported once the backend is checked, as the study definition connects to
+    # DATABASE_URL when it is built
+    import study_definition
+
+    hashes = study_hashes(study_definition.variable_hashes)
+    previous = None
+    if os.path.exists(COHORT_FILE) and os.path.exists(HASHES_FILE):
+        with open(HASHES_FILE) as f:
+            previous = json.load(f)
+
+    if previous is None or previous.get("study_definition") != hashes["study_definition"]:
+        print("Running a full extraction")
+        generate_cohort("output", args.expectations_population, args.store)
+    else:
+        changed = [name for name, value in hashes.items() if previous.get(name) != value]
+        if not changed:
+            print("No variable definitions have changed")
+            return
+        print(f"Extracting changed variables and their dependants: {', '.join(changed)}")
+        generate_cohort(CHANGED_DIR, args.expectations_population, args.store, changed_since=HASHES_FILE)
+        merged = merge_changed_columns(
+            COHORT_FILE,
+            os.path.join(CHANGED_DIR, "input.feather"),
+            study_definition.study.covariate_definitions,
+            dummy_data=bool(args.expectations_population),
+        )
+        if not merged:
+            print("Population has changed since the last extraction, running a full extraction")
+            generate_cohort("output", args.expectations_population, args.store)
+
+    with open(HASHES_FILE, "w") as f:
+        json.dump(hashes, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
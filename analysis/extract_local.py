@@ -0,0 +1,61 @@
+# Extract the study population from a local synthetic EHR store
+#
+# Usage (from the project root):
+#   python analysis/synthetic_store.py --patients N
+#   python analysis/extract_local.py [--store PATH] [--output output/input.feather] [--trace]
+#                                    [--report-codelists] [--param KEY=VALUE ...]
+#
+# The study definition is evaluated against the store by LocalBackend (see
+# local_backend.py) rather than by generating dummy data from the
+# expectations, and the output has the same columns and types as
+# cohortextractor generate_cohort, so the R pipeline can run on it unchanged.
+# With --trace, the time, rows and bytes of every variable are written to
+# logs/ (see variable_tracer.py), and with --report-codelists the codelists
+# the run used are listed in logs/touched_codelists.json (see
+# codelist_cache.py). --param sets the study definition's params, as it does
+# for cohortextractor.
+
+# Import statements
+
+## Command line arguments
+import argparse
+import sys
+
+## Study definition
+from cohortextractor.cohortextractor import load_study_definition
+
+## Codelists
+from codelist_cache import report_touched_codelists
+
+## Local backend
+from local_backend import CHUNK_SIZE, LocalBackend
+from synthetic_store import STORE_FILE
+from variable_tracer import VariableTracer, variable_sources
+
+# Files
+
+COHORT_FILE = "output/input.feather"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default=STORE_FILE)
+    parser.add_argument("--output", default=COHORT_FILE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--trace", action="store_true", help="profile each variable (see variable_tracer.py)")
+    parser.add_argument("--report-codelists", action="store_true", help="list the codelists the run used (see codelist_cache.py)")
+    parser.add_argument("--param", action="append", default=[], help="KEY=VALUE parameter of the study definition")
+    args = parser.parse_args()
+
+    if args.report_codelists:
+        report_touched_codelists()
+
+    study = load_study_definition("study_definition", params=dict(param.split("=", 1) for param in args.param))
+    tracer = VariableTracer(variable_sources(sys.modules["study_definition"])) if args.trace else None
+    LocalBackend(args.store, study.covariate_definitions, args.chunk_size, tracer).to_file(args.output)
+    if tracer is not None:
+        tracer.write()
+
+
+if __name__ == "__main__":
+    main()
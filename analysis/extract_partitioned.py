@@ -0,0 +1,156 @@
+# Generate the cohort in patient-id range partitions, one worker process per
+# partition, and stream the partitions into output/input.feather
+#
+# Usage (from the project root):
+#   python analysis/extract_partitioned.py --expectations-population N [--partitions P]
+#
+# Only dummy data is supported: the script cannot extract from a database, and
+# exits with an error if DATABASE_URL is set, rather than writing dummy data in
+# place of the real cohort. On the backend the whole cohort is a single SQL
+# batch that the database server already parallelises, and a local synthetic
+# store is already extracted in patient chunks by extract_local.py.
+#
+# No variable in the study definition refers to other patients, so every
+# partition is evaluated independently with the full set of variables, which
+# cohortextractor otherwise generates in one process. Partition i gets
+# patient ids in its own range starting at i * 10 * (partition size), the same
+# 10x sparse id space that cohortextractor draws dummy patient ids from.
+#
+# Partitions are written as record batches of at most CHUNK_SIZE patients to
+# an Arrow IPC file (the format of feather V2 files) as soon as each one is
+# ready, so only one partition is held in memory at a time. Dictionary columns
+# are encoded against a vocabulary that only grows, so later batches are
+# written as dictionary deltas and the file reads back as a single table. Only
+# the dummy data of this script is streamed: cohortextractor on the backend and
+# extract_local.py still write the cohort file in one go.
+# Dates are stored as date32 (days) rather than nanosecond timestamps, as no
+# variable is more precise than a day, so they read straight into R as Date.
+# Only this script writes date32 dates: the cohorts of cohortextractor on the
+# backend and of extract_local.py keep nanosecond timestamps, which
+# preprocess_data.R converts to Date as well.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Processes and paths
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+## Random numbers
+import numpy as np
+
+## Arrow tables
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+## Cohort extractor
+from cohortextractor.cohortextractor import load_study_definition
+
+# Files
+
+COHORT_FILE = "output/input.feather"
+PARTITIONS_DIR = "output/partitions"
+
+# Maximum number of patients in each record batch
+CHUNK_SIZE = 10000
+
+
+def partition_sizes(population: int, partitions: int) -> list:
+    """
+    split a population into `partitions` near-equal sizes
+    """
+    size, remainder = divmod(population, partitions)
+    return [size + (i < remainder) for i in range(partitions)]
+
+
+def generate_partition(partition: int, population: int) -> str:
+    """
+    generate dummy data for one partition in a worker process, returning the
+    partition file
+    """
+    study = load_study_definition("study_definition")
+    # The study definition seeds every worker the same way; give each partition its own patients
+    np.random.seed([123456, partition])
+    filename = os.path.join(PARTITIONS_DIR, f"input_{partition}.feather")
+    study.to_file(filename, expectations_population=population)
+    return filename
+
+
+def compact_dates(table: pa.Table) -> pa.Table:
+    """
+    store timestamp columns as date32, halving their size
+    """
+    for column, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(column, field.name, pc.cast(table.column(column), pa.date32()))
+    return table
+
+
+def encode_dictionaries(table: pa.Table, vocabularies: dict) -> pa.Table:
+    """
+    re-encode the dictionary columns of a table against vocabularies shared by
+    all partitions, appending any values not seen before, so that each
+    partition's dictionaries extend those of the partitions before it
+    """
+    for column, field in enumerate(table.schema):
+        if not pa.types.is_dictionary(field.type):
+            continue
+        values = pc.cast(table.column(column), field.type.value_type).combine_chunks()
+        vocabulary = vocabularies.setdefault(field.name, [])
+        vocabulary.extend(
+            value for value in pc.unique(values).to_pylist()
+            if value is not None and value not in vocabulary
+        )
+        dictionary = pa.array(vocabulary, field.type.value_type)
+        indices = pc.index_in(values, value_set=dictionary)
+        table = table.set_column(
+            column, field.name, pa.DictionaryArray.from_arrays(indices, dictionary)
+        )
+    return table
+
+
+def write_partitions(filenames, sizes: list, path: str):
+    """
+    stream partition files into one Arrow IPC file as they are generated,
+    moving each partition's patient ids into its own range
+    """
+    writer = None
+    vocabularies = {}
+    offset = 0
+    for filename, size in zip(filenames, sizes):
+        table = feather.read_table(filename)
+        column = table.schema.get_field_index("patient_id")
+        patient_id = pc.add(table["patient_id"], pa.scalar(offset, table.schema.field(column).type))
+        table = table.set_column(column, "patient_id", patient_id)
+        table = encode_dictionaries(compact_dates(table), vocabularies)
+        if writer is None:
+            writer = pa.ipc.new_file(
+                path, table.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            )
+        writer.write_table(table, max_chunksize=CHUNK_SIZE)
+        os.remove(filename)
+        offset += size * 10
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--expectations-population", type=int, required=True)
+    parser.add_argument("--partitions", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if os.environ.get("DATABASE_URL"):
+        parser.error("partitioned extraction only generates dummy data; unset DATABASE_URL")
+
+    os.makedirs(PARTITIONS_DIR, exist_ok=True)
+    sizes = partition_sizes(args.expectations_population, args.partitions)
+    with ProcessPoolExecutor(max_workers=args.partitions) as pool:
+        filenames = pool.map(generate_partition, range(args.partitions), sizes)
+        write_partitions(filenames, sizes, COHORT_FILE)
+    os.rmdir(PARTITIONS_DIR)
+
+
+if __name__ == "__main__":
+    main()
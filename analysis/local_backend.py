@@ -0,0 +1,865 @@
+# Evaluate the study definition against a local synthetic EHR store (see
+# synthetic_store.py), in place of the TPP database
+#
+# LocalBackend follows the TPP backend of cohortextractor: each variable is a
+# query over one source table (patients_<query_type>() below, returning the
+# same columns as the TPP query, e.g. binary_flag and date), combined into
+# output columns with the same missing values (ISNULL defaults), date
+# truncation, minimum_of/maximum_of and categorised_as semantics. Only the
+# query types and arguments this study uses are supported.
+#
+# Patients are evaluated in chunks of CHUNK_SIZE patient ids. Each table is
+# read once per chunk, sorted by patient and date, and its codes are matched
+# against all the codelists the study queries it with in a single pass (see
+# codelist_index.py; the numeric dm+d medication codes are searched as sorted
+# arrays), so each variable is a bit test, a date filter and a per-patient
+# reduction over arrays. categorised_as expressions are compiled
+# to NumPy kernels with the semantics of the CASE expressions the TPP backend
+# generates (see expression_compiler.py).
+
+# Import statements
+
+## Database
+import sqlite3
+
+## Timing
+import time
+
+## Arrays and data frames
+import numpy as np
+import pandas as pd
+
+## Cohort extractor
+from cohortextractor.date_expressions import DateExpressionEvaluator
+from cohortextractor.pandas_utils import dataframe_to_file
+
+## Codelist matching
+from codelist_index import CodelistIndex, NumericCodelistIndex, PrefixIndex
+
+## Store layout
+from synthetic_store import BMI_CODE, CAUSE_POSITIONS, DIAGNOSIS_POSITIONS, table_codelists
+
+## Compiled categorised_as expressions
+from expression_compiler import compile_categories
+
+## Study definition planner
+from study_def_planner import codelist_key, variable_references
+
+## Per-variable profiling
+from variable_tracer import column_bytes
+
+# Patient ids evaluated at a time
+CHUNK_SIZE = 200000
+
+# Columns read from each table, with the type of each: "date" columns are
+# read as datetime64[D], "code" columns as strings with "" for NULL
+TABLE_COLUMNS = {
+    "patient": {"date_of_birth": "date", "sex": "code", "date_of_death": "date"},
+    "registration": {"start_date": "date", "end_date": "date", "region": "code"},
+    "address": {"start_date": "date", "end_date": "date", "imd": "int", "care_home": "code"},
+    "clinical_event": {"date": "date", "system": "code", "code": "code", "value": "float"},
+    "medication": {"date": "date", "code": "code"},
+    "apcs": dict(
+        {"admission_date": "date", "ethnic_group": "code", "primary_diagnosis": "code"},
+        **{f"diagnosis_{i:02d}": "code" for i in range(1, DIAGNOSIS_POSITIONS + 1)},
+    ),
+    "ons_death": dict(
+        {"date": "date", "underlying_cause": "code"},
+        **{f"cause_{i:02d}": "code" for i in range(1, CAUSE_POSITIONS + 1)},
+    ),
+    "sgss_test": {"specimen_date": "date", "result": "code"},
+    "vaccination": {"date": "date", "target_disease": "code", "healthcare_worker": "int"},
+    "gp_consultation": {"date": "date"},
+}
+
+# Index of the codelists of each table, where it is not a CodelistIndex:
+# hospital diagnoses are matched by prefix, and the numeric dm+d codes of
+# medications by searching sorted arrays of codes
+CODELIST_INDEXES = {"apcs": PrefixIndex, "medication": NumericCodelistIndex}
+
+# Date column events are ordered by, by table
+EVENT_DATES = {
+    "registration": "start_date",
+    "address": "start_date",
+    "clinical_event": "date",
+    "medication": "date",
+    "apcs": "admission_date",
+    "ons_death": "date",
+    "sgss_test": "specimen_date",
+    "vaccination": "date",
+    "gp_consultation": "date",
+}
+
+# Mapping of the first character of a SUS ethnicity code to the 6 groups
+ETHNICITY_GROUP_6 = {
+    "A": "1", "B": "1", "C": "1", "D": "2", "E": "2", "F": "2", "G": "2", "H": "3",
+    "J": "3", "K": "3", "L": "3", "M": "4", "N": "4", "P": "4", "R": "5", "S": "5",
+}
+
+# Date that MSSQL casts an empty date to, used for date references to
+# variables that have no date
+EMPTY_DATE = np.datetime64("1900-01-01", "D")
+
+NOT_A_DATE = np.datetime64("NaT", "D")
+
+# Query types evaluated from other variables rather than from the store
+DERIVED_QUERIES = {"fixed_value", "categorised_as", "aggregate_of", "value_from"}
+
+
+def empty_value(column_type: str, returning=None):
+    """
+    value of a missing result of a column type, as in
+    TPPBackend.get_default_value_for_type()
+    """
+    if returning == "index_of_multiple_deprivation":
+        return -1
+    return {"date": "", "str": "", "bool": 0, "int": 0, "float": 0.0}[column_type]
+
+
+def truncate_dates(dates: np.ndarray, date_format) -> np.ndarray:
+    """
+    dates truncated to the precision of `date_format` (the first of the year
+    or month), where no format means a year, as in the TPP backend
+    """
+    if date_format in (None, "YYYY"):
+        return dates.astype("datetime64[Y]").astype("datetime64[D]")
+    if date_format == "YYYY-MM":
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+    if date_format == "YYYY-MM-DD":
+        return dates
+    raise ValueError(f"Unhandled date format: {date_format}")
+
+
+def format_dates(dates: np.ndarray, date_format) -> np.ndarray:
+    """
+    dates as the strings the TPP backend outputs, with "" for missing dates
+    """
+    unit = {None: "Y", "YYYY": "Y", "YYYY-MM": "M", "YYYY-MM-DD": "D"}[date_format]
+    strings = np.datetime_as_string(dates.astype(f"datetime64[{unit}]")).astype(object)
+    strings[np.isnat(dates)] = ""
+    return strings
+
+
+def add_months(dates: np.ndarray, months: int) -> np.ndarray:
+    """
+    dates moved by a number of months, clamped to the end of the month as
+    MSSQL DATEADD does
+    """
+    month = dates.astype("datetime64[M]")
+    days = dates - month.astype("datetime64[D]")
+    moved = month + months
+    last = (moved + 1).astype("datetime64[D]") - 1
+    return np.minimum(moved.astype("datetime64[D]") + days, last)
+
+
+def first_per_patient(positions: np.ndarray, mask: np.ndarray, size: int, last=False) -> np.ndarray:
+    """
+    index of the first (or last) matching row of each patient in rows sorted
+    by patient and date, with -1 for patients with no matching rows
+    """
+    rows = np.flatnonzero(mask)
+    if last:
+        rows = rows[::-1]
+    patients, first = np.unique(positions[rows], return_index=True)
+    selected = np.full(size, -1, dtype=np.int64)
+    selected[patients] = rows[first]
+    return selected
+
+
+def take(values: np.ndarray, rows: np.ndarray, missing) -> np.ndarray:
+    """
+    values of the selected rows, with `missing` where no row was selected
+    """
+    if len(values) == 0:
+        return np.full(len(rows), missing, dtype=values.dtype)
+    result = values[rows.clip(min=0)]
+    result[rows < 0] = missing
+    return result
+
+
+def check_unsupported(query_type: str, arguments: dict):
+    """
+    raise an error for arguments that change a query's results but are not
+    supported locally
+    """
+    used = [arg for arg, value in arguments.items() if value not in (None, False)]
+    if used:
+        raise ValueError(f"Unsupported arguments for {query_type} in local backend: {', '.join(used)}")
+
+
+class Chunk:
+    """
+    the patients in a range of patient ids, the rows of each table for those
+    patients, and the columns evaluated so far
+    """
+
+    def __init__(self, connection, first_id: int, last_id: int):
+        self.connection = connection
+        self.first_id = first_id
+        self.last_id = last_id
+        self.tables = {}
+        self.bitsets = {}
+        self.results = {}
+        self.columns = {}
+        self.formatted = {}
+        self.rows_scanned = 0
+        self.rows_touched = 0
+        # Seconds spent reading and classifying each table, and rows read
+        self.scans = {}
+        self.patient_id = self.table("patient")["patient_id"]
+        self.size = len(self.patient_id)
+
+    def table(self, name: str) -> dict:
+        """
+        columns of a table for the patients in the chunk, sorted by patient
+        and date, with the position of each row's patient in "position"
+        """
+        if name in self.tables:
+            self.rows_touched += len(self.tables[name]["patient_id"])
+            return self.tables[name]
+        start = time.perf_counter()
+        types = TABLE_COLUMNS[name]
+        selected = ", ".join(
+            f"IFNULL({column}, '')" if kind == "code" else column for column, kind in types.items()
+        )
+        rows = self.connection.execute(
+            f"SELECT patient_id, {selected} FROM {name} WHERE patient_id BETWEEN ? AND ?",
+            (self.first_id, self.last_id),
+        ).fetchall()
+        self.rows_scanned += len(rows)
+        values = list(zip(*rows)) or [()] * (len(types) + 1)
+        table = {"patient_id": np.array(values[0], dtype=np.int64)}
+        for (column, kind), column_values in zip(types.items(), values[1:]):
+            if kind == "date":
+                table[column] = np.array(column_values, dtype="datetime64[D]")
+            elif kind == "code":
+                table[column] = np.array(column_values, dtype=object)
+            elif kind == "int":
+                table[column] = np.array(column_values, dtype=np.int64)
+            else:
+                table[column] = np.array(column_values, dtype=np.float64)
+        if name == "patient":
+            order = np.argsort(table["patient_id"], kind="stable")
+        else:
+            table["position"] = np.searchsorted(self.patient_id, table["patient_id"])
+            order = np.lexsort((table[EVENT_DATES[name]], table["position"]))
+        table = {column: values[order] for column, values in table.items()}
+        self.tables[name] = table
+        self.rows_touched += len(table["patient_id"])
+        self.record_scan(name, time.perf_counter() - start, len(rows))
+        return table
+
+    def record_scan(self, name: str, seconds: float, rows=0):
+        scan = self.scans.setdefault(name, {"seconds": 0.0, "rows": 0})
+        scan["seconds"] += seconds
+        scan["rows"] += rows
+
+    def scan_seconds(self) -> float:
+        return sum(scan["seconds"] for scan in self.scans.values())
+
+
+class LocalBackend:
+    """
+    backend evaluating covariate definitions against a synthetic store
+    """
+
+    def __init__(self, store: str, covariate_definitions: dict, chunk_size=CHUNK_SIZE, tracer=None):
+        self.store = store
+        self.covariate_definitions = covariate_definitions
+        self.chunk_size = chunk_size
+        self.tracer = tracer
+        self.indexes = {}
+        for table, codelists in table_codelists(covariate_definitions).items():
+            keyed = {codelist_key(codelist): codelist for codelist in codelists}
+            names = {str(number): codelist for number, codelist in enumerate(keyed.values())}
+            self.indexes[table] = {
+                "names": {key: str(number) for number, key in enumerate(keyed)},
+                "systems": {
+                    system: CODELIST_INDEXES.get(table, CodelistIndex)(names, system)
+                    for system in {codelist.system for codelist in codelists}
+                },
+            }
+        self.rows_scanned = 0
+
+    # Codelists and dates
+
+    def in_codelist(self, chunk: Chunk, table: str, codelist, columns=("code",)) -> np.ndarray:
+        """
+        boolean mask of the rows of a table with a code in `codelist` in any
+        of `columns`, from a classification against all the table's
+        codelists (bitsets, or masks for medications) computed once per chunk
+        """
+        index = self.indexes[table]["systems"][codelist.system]
+        key = (table, codelist.system, columns)
+        if key not in chunk.bitsets:
+            # Classifying is part of the scan, so the rows count as touched by the variable only once
+            rows = chunk.tables.get(table) or chunk.table(table)
+            start = time.perf_counter()
+            codes = np.stack([rows[column] for column in columns], axis=1).astype(str)
+            bitsets = index.classify_positions(codes)
+            if "system" in rows:
+                bitsets[rows["system"] != codelist.system] = 0
+            chunk.bitsets[key] = bitsets
+            chunk.record_scan(table, time.perf_counter() - start)
+        return index.members(chunk.bitsets[key], self.indexes[table]["names"][codelist_key(codelist)])
+
+    def date_reference(self, chunk: Chunk, date):
+        """
+        a date, or a date expression referring to another variable (e.g.
+        "exp_date + 1 day"), as a datetime64 scalar or an array of one date
+        per patient
+        """
+        if date is None:
+            return None
+        match = DateExpressionEvaluator.regex.match(date.replace(" ", ""))
+        if not match or match["name"] not in chunk.columns:
+            return np.datetime64(date, "D")
+        dates = chunk.columns[match["name"]].copy()
+        dates[np.isnat(dates)] = EMPTY_DATE
+        function = match["function"]
+        if function == "first_day_of_month":
+            dates = dates.astype("datetime64[M]").astype("datetime64[D]")
+        elif function == "last_day_of_month":
+            dates = (dates.astype("datetime64[M]") + 1).astype("datetime64[D]") - 1
+        elif function == "first_day_of_year":
+            dates = dates.astype("datetime64[Y]").astype("datetime64[D]")
+        elif function == "last_day_of_year":
+            dates = (dates.astype("datetime64[Y]") + 1).astype("datetime64[D]") - 1
+        elif function is not None:
+            raise ValueError(f"Unsupported date function in local backend: {function}")
+        if match["operator"]:
+            quantity = int(match["quantity"]) * (1 if match["operator"] == "+" else -1)
+            units = match["units"].rstrip("s")
+            if units == "day":
+                dates = dates + quantity
+            elif units == "month":
+                dates = add_months(dates, quantity)
+            elif units == "year":
+                dates = add_months(dates, 12 * quantity)
+            else:
+                raise ValueError(f"Unsupported date units in local backend: {units}")
+        return dates
+
+    def in_window(self, chunk: Chunk, dates: np.ndarray, positions: np.ndarray, between) -> np.ndarray:
+        """
+        boolean mask of the rows whose date is within `between` (inclusive),
+        where the bounds may be per patient
+        """
+        mask = ~np.isnat(dates)
+        for bound, inside in zip(between or (None, None), (np.greater_equal, np.less_equal)):
+            bound = self.date_reference(chunk, bound)
+            if bound is not None:
+                mask &= inside(dates, bound[positions] if np.ndim(bound) else bound)
+        return mask
+
+    # Queries of coded events
+
+    def summarise_events(self, chunk, rows, mask, returning, find_first_match_in_period, values=None):
+        """
+        TPP columns of a query returning a flag, date, count or the value of
+        the first or last matching event (and its date)
+        """
+        positions = rows["position"]
+        selected = first_per_patient(positions, mask, chunk.size, last=not find_first_match_in_period)
+        date = take(rows["date"], selected, NOT_A_DATE)
+        if returning in ("binary_flag", "date"):
+            return {"binary_flag": (selected >= 0).astype(np.int64), "date": date}
+        if returning == "number_of_matches_in_period":
+            count = np.bincount(positions[mask], minlength=chunk.size)
+            return {"number_of_matches_in_period": count, "date": date}
+        if values is None:
+            raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+        return {returning: take(values, selected, "" if values.dtype == object else 0.0), "date": date}
+
+    def patients_with_these_clinical_events(
+        self,
+        chunk,
+        codelist,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        returning="binary_flag",
+        include_date_of_match=False,
+        ignore_missing_values=False,
+        **unsupported,
+    ):
+        check_unsupported("with_these_clinical_events", unsupported)
+        rows = chunk.table("clinical_event")
+        mask = self.in_codelist(chunk, "clinical_event", codelist) & self.in_window(
+            chunk, rows["date"], rows["position"], between
+        )
+        if ignore_missing_values:
+            mask &= rows["value"] != 0
+        values = None
+        if returning == "category":
+            categories = dict(codelist)
+            values = np.full(len(mask), "", dtype=object)
+            values[mask] = [categories.get(code, "") for code in rows["code"][mask]]
+        elif returning == "numeric_value":
+            values = rows["value"]
+        elif returning == "code":
+            values = rows["code"]
+        return self.summarise_events(chunk, rows, mask, returning, find_first_match_in_period, values)
+
+    def patients_with_these_medications(
+        self,
+        chunk,
+        codelist,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        returning="binary_flag",
+        include_date_of_match=False,
+        **unsupported,
+    ):
+        check_unsupported("with_these_medications", unsupported)
+        rows = chunk.table("medication")
+        mask = self.in_codelist(chunk, "medication", codelist) & self.in_window(
+            chunk, rows["date"], rows["position"], between
+        )
+        return self.summarise_events(chunk, rows, mask, returning, find_first_match_in_period, rows["code"])
+
+    def patients_max_recorded_value(
+        self,
+        chunk,
+        codelist,
+        on_most_recent_day_of_measurement=None,
+        between=None,
+        include_date_of_match=False,
+    ):
+        if not on_most_recent_day_of_measurement:
+            raise ValueError("max_recorded_value is only supported on the most recent day of measurement")
+        rows = chunk.table("clinical_event")
+        positions = rows["position"]
+        mask = self.in_codelist(chunk, "clinical_event", codelist) & self.in_window(
+            chunk, rows["date"], positions, between
+        )
+        latest = take(rows["date"], first_per_patient(positions, mask, chunk.size, last=True), NOT_A_DATE)
+        on_day = mask & (rows["date"] == latest[positions])
+        value = np.full(chunk.size, -np.inf)
+        np.maximum.at(value, positions[on_day], rows["value"][on_day])
+        return {"value": np.where(np.isinf(value), 0.0, value), "date": latest}
+
+    def patients_most_recent_bmi(
+        self,
+        chunk,
+        between=None,
+        minimum_age_at_measurement=16,
+        include_date_of_match=False,
+    ):
+        # Recorded BMI only: the synthetic store has no weight and height events
+        rows = chunk.table("clinical_event")
+        positions = rows["position"]
+        birth = chunk.table("patient")["date_of_birth"][positions]
+        mask = (
+            (rows["system"] == "ctv3")
+            & (rows["code"] == BMI_CODE)
+            & self.in_window(chunk, rows["date"], positions, between)
+            & (add_months(birth, 12 * minimum_age_at_measurement) <= rows["date"])
+        )
+        selected = first_per_patient(positions, mask, chunk.size, last=True)
+        return {"value": take(rows["value"], selected, 0.0), "date": take(rows["date"], selected, NOT_A_DATE)}
+
+    def patients_admitted_to_hospital(
+        self,
+        chunk,
+        between=None,
+        returning=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        with_these_primary_diagnoses=None,
+        with_these_diagnoses=None,
+        **unsupported,
+    ):
+        check_unsupported("admitted_to_hospital", unsupported)
+        rows = chunk.table("apcs")
+        positions = rows["position"]
+        mask = self.in_window(chunk, rows["admission_date"], positions, between)
+        if with_these_primary_diagnoses:
+            mask &= self.in_codelist(chunk, "apcs", with_these_primary_diagnoses, ("primary_diagnosis",))
+        if with_these_diagnoses:
+            columns = tuple(f"diagnosis_{i:02d}" for i in range(1, DIAGNOSIS_POSITIONS + 1))
+            mask &= self.in_codelist(chunk, "apcs", with_these_diagnoses, columns)
+        selected = first_per_patient(positions, mask, chunk.size, last=not find_first_match_in_period)
+        if returning == "binary_flag":
+            return {"binary_flag": (selected >= 0).astype(np.int64)}
+        if returning == "date_admitted":
+            return {"date_admitted": take(rows["admission_date"], selected, NOT_A_DATE)}
+        if returning == "number_of_matches_in_period":
+            return {"number_of_matches_in_period": np.bincount(positions[mask], minlength=chunk.size)}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    def patients_with_these_codes_on_death_certificate(
+        self,
+        chunk,
+        codelist=None,
+        between=None,
+        match_only_underlying_cause=False,
+        returning="binary_flag",
+    ):
+        rows = chunk.table("ons_death")
+        positions = rows["position"]
+        mask = self.in_window(chunk, rows["date"], positions, between)
+        if codelist is not None:
+            columns = ("underlying_cause",)
+            if not match_only_underlying_cause:
+                columns += tuple(f"cause_{i:02d}" for i in range(1, CAUSE_POSITIONS + 1))
+            mask &= self.in_codelist(chunk, "ons_death", codelist, columns)
+        selected = first_per_patient(positions, mask, chunk.size)
+        if returning == "binary_flag":
+            return {"binary_flag": (selected >= 0).astype(np.int64)}
+        if returning == "date_of_death":
+            return {"date_of_death": take(rows["date"], selected, NOT_A_DATE)}
+        if returning == "underlying_cause_of_death":
+            return {"underlying_cause_of_death": take(rows["underlying_cause"], selected, "")}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    def patients_died_from_any_cause(self, chunk, between=None, returning="binary_flag"):
+        return self.patients_with_these_codes_on_death_certificate(chunk, between=between, returning=returning)
+
+    def patients_with_death_recorded_in_primary_care(self, chunk, between=None, returning="binary_flag"):
+        dates = chunk.table("patient")["date_of_death"]
+        start, end = between or (None, None)
+        mask = self.in_window(chunk, dates, np.arange(chunk.size), (start or "1900-01-01", end or "3000-01-01"))
+        if returning == "binary_flag":
+            return {"binary_flag": mask.astype(np.int64)}
+        if returning == "date_of_death":
+            return {"date_of_death": np.where(mask, dates, NOT_A_DATE)}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    def patients_with_test_result_in_sgss(
+        self,
+        chunk,
+        pathogen=None,
+        test_result=None,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        restrict_to_earliest_specimen_date=True,
+        returning="binary_flag",
+        include_date_of_match=False,
+    ):
+        assert pathogen == "SARS-CoV-2"
+        rows = chunk.table("sgss_test")
+        positions = rows["position"]
+        results = ["positive", "negative"] if test_result == "any" else [test_result]
+        mask = np.zeros(len(positions), dtype=bool)
+        for result in results:
+            tests = rows["result"] == result
+            if restrict_to_earliest_specimen_date:
+                # Only the earliest positive (or negative) test of each patient is kept
+                earliest = first_per_patient(positions, tests, chunk.size)
+                tests = np.zeros(len(positions), dtype=bool)
+                tests[earliest[earliest >= 0]] = True
+            mask |= tests
+        mask &= self.in_window(chunk, rows["specimen_date"], positions, between)
+        selected = first_per_patient(positions, mask, chunk.size, last=not find_first_match_in_period)
+        if returning in ("binary_flag", "date"):
+            return {"binary_flag": (selected >= 0).astype(np.int64), "date": take(rows["specimen_date"], selected, NOT_A_DATE)}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    def patients_with_tpp_vaccination_record(
+        self,
+        chunk,
+        target_disease_matches=None,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        returning="binary_flag",
+        **unsupported,
+    ):
+        check_unsupported("with_tpp_vaccination_record", unsupported)
+        rows = chunk.table("vaccination")
+        positions = rows["position"]
+        mask = self.in_window(chunk, rows["date"], positions, between)
+        if target_disease_matches:
+            mask &= rows["target_disease"] == target_disease_matches
+        selected = first_per_patient(positions, mask, chunk.size, last=not find_first_match_in_period)
+        if returning == "binary_flag":
+            return {"binary_flag": (selected >= 0).astype(np.int64)}
+        if returning == "date":
+            return {"date": take(rows["date"], selected, NOT_A_DATE)}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    def patients_with_healthcare_worker_flag_on_covid_vaccine_record(self, chunk, returning="binary_flag"):
+        rows = chunk.table("vaccination")
+        flag = np.bincount(rows["position"], weights=rows["healthcare_worker"], minlength=chunk.size) > 0
+        return {returning: flag.astype(np.int64)}
+
+    def patients_with_gp_consultations(
+        self,
+        chunk,
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        returning="binary_flag",
+    ):
+        if returning not in ("binary_flag", "number_of_matches_in_period"):
+            raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+        rows = chunk.table("gp_consultation")
+        mask = self.in_window(chunk, rows["date"], rows["position"], between)
+        count = np.bincount(rows["position"][mask], minlength=chunk.size)
+        if returning == "binary_flag":
+            return {"binary_flag": (count > 0).astype(np.int64)}
+        return {returning: count}
+
+    def patients_with_ethnicity_from_sus(self, chunk, returning="code", use_most_frequent_code=None):
+        if not use_most_frequent_code:
+            raise ValueError("use_most_frequent_code must be set to 'True'")
+        rows = chunk.table("apcs")
+        codes = rows["ethnic_group"]
+        valid = (codes != "") & (codes != "99") & ~pd.Series(codes, dtype=object).str.startswith("Z").to_numpy(bool)
+        counts = (
+            pd.DataFrame({"position": rows["position"][valid], "code": codes[valid]})
+            .value_counts()
+            .reset_index(name="count")
+            .sort_values(["position", "count", "code"], ascending=[True, False, True])
+            .drop_duplicates("position")
+        )
+        code = np.full(chunk.size, "", dtype=object)
+        code[counts["position"].to_numpy()] = counts["code"].to_numpy()
+        if returning == "code":
+            return {"code": code}
+        if returning == "group_6":
+            return {"group_6": np.array([ETHNICITY_GROUP_6.get(value[:1], "0") if value else "" for value in code], dtype=object)}
+        raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+
+    # Queries of patient demographics, registrations and addresses
+
+    def patients_sex(self, chunk):
+        return {"value": chunk.table("patient")["sex"]}
+
+    def patients_date_of_birth(self, chunk):
+        return {"value": chunk.table("patient")["date_of_birth"]}
+
+    def patients_age_as_of(self, chunk, reference_date):
+        birth = chunk.table("patient")["date_of_birth"]
+        reference = np.broadcast_to(self.date_reference(chunk, reference_date), birth.shape)
+        years = reference.astype("datetime64[Y]").astype(np.int64) - birth.astype("datetime64[Y]").astype(np.int64)
+        birthday = add_months(birth, 12 * years)
+        return {"value": np.where(birthday > reference, years - 1, years)}
+
+    def active_rows(self, chunk, table: str, start_date, end_date=None) -> np.ndarray:
+        """
+        boolean mask of the registrations (or addresses) that start on or
+        before `start_date` and end after `end_date`
+        """
+        rows = chunk.table(table)
+        positions = rows["position"]
+        start = self.date_reference(chunk, start_date)
+        end = self.date_reference(chunk, end_date or start_date)
+        start = start[positions] if np.ndim(start) else start
+        end = end[positions] if np.ndim(end) else end
+        return (rows["start_date"] <= start) & (rows["end_date"] > end)
+
+    def patients_registered_with_one_practice_between(self, chunk, start_date, end_date, **unsupported):
+        check_unsupported("registered_with_one_practice_between", unsupported)
+        rows = chunk.table("registration")
+        registered = np.bincount(rows["position"], weights=self.active_rows(chunk, "registration", start_date, end_date), minlength=chunk.size)
+        return {"value": (registered > 0).astype(np.int64)}
+
+    def patients_registered_as_of(self, chunk, reference_date):
+        return self.patients_registered_with_one_practice_between(chunk, reference_date, reference_date)
+
+    def patients_registered_practice_as_of(self, chunk, date, returning=None):
+        if returning != "nuts1_region_name":
+            raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+        rows = chunk.table("registration")
+        # The most recent registration active on the date
+        selected = first_per_patient(rows["position"], self.active_rows(chunk, "registration", date), chunk.size, last=True)
+        return {returning: take(rows["region"], selected, "")}
+
+    def patients_address_as_of(self, chunk, date, returning=None, round_to_nearest=None):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"Unsupported `returning` value in local backend: {returning}")
+        rows = chunk.table("address")
+        selected = first_per_patient(rows["position"], self.active_rows(chunk, "address", date), chunk.size, last=True)
+        imd = take(rows["imd"], selected, -1)
+        if round_to_nearest:
+            imd = np.where(imd >= 0, np.round(imd / round_to_nearest).astype(np.int64) * round_to_nearest, imd)
+        return {returning: imd}
+
+    def patients_care_home_status_as_of(self, chunk, date, categorised_as=None):
+        rows = chunk.table("address")
+        selected = first_per_patient(rows["position"], self.active_rows(chunk, "address", date), chunk.size, last=True)
+        care_home = take(rows["care_home"], selected, "")
+        columns = {
+            "IsPotentialCareHome": ((care_home != "") * 1, 0),
+            "LocationRequiresNursing": (np.where(care_home == "nursing_home", "Y", "N").astype(object), ""),
+            "LocationDoesNotRequireNursing": (np.where(care_home == "care_home", "Y", "N").astype(object), ""),
+        }
+        return {"value": self.evaluate_categories(categorised_as, columns, chunk.size)}
+
+    # Variables derived from other variables
+
+    def evaluate_categories(self, category_definitions: dict, columns: dict, size: int) -> np.ndarray:
+        """
+        category of each patient from a dictionary of category: expression,
+        evaluated as the CASE expression of the TPP backend over `columns`
+        (name: (values, empty value)) by a compiled kernel
+        """
+        empty_values = {name: empty for name, (values, empty) in columns.items()}
+        kernel, names = compile_categories(category_definitions, empty_values)
+        return kernel({name: columns[name][0] for name in names}, size)
+
+    def expression_columns(self, chunk: Chunk, names) -> dict:
+        """
+        columns in `names` evaluated so far, as the values and empty value
+        each has in the output of the TPP backend
+        """
+        columns = {}
+        for name in names:
+            query_type, query_args = self.covariate_definitions[name]
+            column_type = query_args["column_type"]
+            if name not in chunk.formatted:
+                values = chunk.columns[name]
+                if column_type == "date":
+                    values = format_dates(values, self.date_format(name))
+                chunk.formatted[name] = values
+            columns[name] = (chunk.formatted[name], empty_value(column_type, query_args.get("returning")))
+        return columns
+
+    def patients_categorised_as(self, chunk, category_definitions, column_type, date_format=None):
+        names = variable_references("categorised_as", {"category_definitions": category_definitions}, set(chunk.columns))
+        categories = self.evaluate_categories(category_definitions, self.expression_columns(chunk, names), chunk.size)
+        if column_type == "date":
+            return np.array([value or None for value in categories], dtype="datetime64[D]")
+        if column_type in ("bool", "int"):
+            return categories.astype(np.int64)
+        if column_type == "float":
+            return categories.astype(np.float64)
+        return categories.astype(str).astype(object)
+
+    def patients_aggregate_of(self, chunk, column_names, aggregate_function, column_type, date_format=None):
+        """
+        minimum or maximum of other columns, ignoring their empty values
+        """
+        columns = [chunk.columns[name] for name in column_names]
+        if column_type == "date":
+            reduce = np.fmin if aggregate_function == "MIN" else np.fmax
+            return reduce.reduce(np.stack(columns), axis=0)
+        empty = empty_value(column_type)
+        values = np.stack(columns).astype(np.float64)
+        values[values == empty] = np.inf if aggregate_function == "MIN" else -np.inf
+        result = values.min(axis=0) if aggregate_function == "MIN" else values.max(axis=0)
+        result[np.isinf(result)] = empty
+        return result.astype(np.int64 if column_type in ("int", "bool") else np.float64)
+
+    # Evaluation
+
+    def date_format(self, name: str):
+        """
+        format of a date column: categorised_as dates are full dates and
+        aggregates take the format of their first column, as in the TPP backend
+        """
+        query_type, query_args = self.covariate_definitions[name]
+        if query_type == "categorised_as":
+            return "YYYY-MM-DD"
+        if query_type == "aggregate_of":
+            return self.date_format(query_args["column_names"][0])
+        return query_args.get("date_format")
+
+    def evaluate_chunk(self, chunk: Chunk):
+        """
+        evaluate every variable for the patients in a chunk, in the order
+        they are defined. Reading and classifying a table is traced as a scan
+        of the table rather than charged to the first variable to use it.
+        """
+        for name, (query_type, query_args) in self.covariate_definitions.items():
+            query_args = {
+                arg: value for arg, value in query_args.items()
+                if arg not in ("return_expectations", "hidden")
+            }
+            column_type = query_args.pop("column_type")
+            start, touched, scanned = time.perf_counter(), chunk.rows_touched, chunk.scan_seconds()
+            if query_type == "fixed_value":
+                value = query_args["value"]
+                column = np.full(chunk.size, np.datetime64(value, "D") if column_type == "date" else value)
+            elif query_type == "categorised_as":
+                column = self.patients_categorised_as(chunk, column_type=column_type, **query_args)
+            elif query_type == "aggregate_of":
+                column = self.patients_aggregate_of(chunk, column_type=column_type, **query_args)
+            elif query_type == "value_from":
+                column = chunk.results[query_args["source"]][query_args["returning"]]
+            else:
+                query_args.pop("date_format", None)
+                results = getattr(self, f"patients_{query_type}")(chunk, **query_args)
+                chunk.results[name] = results
+                column = results[query_args.get("returning") or "value"]
+            queried = time.perf_counter()
+            if column_type == "date":
+                column = truncate_dates(np.asarray(column, dtype="datetime64[D]"), self.date_format(name))
+            chunk.columns[name] = column
+            if self.tracer is not None:
+                self.tracer.record(
+                    name,
+                    query_seconds=queried - start - (chunk.scan_seconds() - scanned),
+                    materialise_seconds=time.perf_counter() - queried,
+                    # Variables derived from other variables touch one row per patient
+                    rows_touched=(chunk.rows_touched - touched) or (chunk.size if query_type in DERIVED_QUERIES else 0),
+                    output_bytes=column_bytes(column),
+                )
+        if self.tracer is not None:
+            for table, scan in chunk.scans.items():
+                self.tracer.record_scan(table, seconds=scan["seconds"], rows=scan["rows"])
+
+    def chunks(self, connection):
+        """
+        ranges of patient ids of at most `chunk_size` ids covering the store
+        """
+        first_id, last_id = connection.execute("SELECT MIN(patient_id), MAX(patient_id) FROM patient").fetchone()
+        for start in range(first_id or 0, (last_id or -1) + 1, self.chunk_size):
+            yield start, start + self.chunk_size - 1
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        the output columns of the patients in the study population, with
+        the same types as a cohortextractor extraction
+        """
+        connection = sqlite3.connect(self.store)
+        output = [
+            name for name, (query_type, query_args) in self.covariate_definitions.items()
+            if not query_args.get("hidden") and name != "population"
+        ]
+        parts = []
+        for first_id, last_id in self.chunks(connection):
+            chunk = Chunk(connection, first_id, last_id)
+            self.evaluate_chunk(chunk)
+            self.rows_scanned += chunk.rows_scanned
+            population = chunk.columns["population"].astype(bool)
+            parts.append(
+                pd.DataFrame(
+                    dict(
+                        patient_id=chunk.patient_id[population],
+                        **{name: chunk.columns[name][population] for name in output},
+                    )
+                )
+            )
+        connection.close()
+        df = pd.concat(parts, ignore_index=True)
+        for name in output:
+            start = time.perf_counter()
+            df[name] = self.output_column(name, df[name])
+            if self.tracer is not None:
+                self.tracer.record(name, materialise_seconds=time.perf_counter() - start)
+        return df
+
+    def output_column(self, name: str, values: pd.Series) -> pd.Series:
+        """
+        an evaluated column converted to the type cohortextractor gives it
+        (see cohortextractor.pandas_utils.get_pandas_convertor())
+        """
+        query_type, query_args = self.covariate_definitions[name]
+        column_type = query_args["column_type"]
+        if column_type == "str" or query_args.get("returning") in ("index_of_multiple_deprivation", "rural_urban_classification"):
+            empty = values.isin(["", 0]) | values.isna()
+            categories = pd.unique(values[~empty])
+            return pd.Series(pd.Categorical(values.where(~empty), categories=categories), index=values.index)
+        if column_type == "date":
+            return pd.to_datetime(values)
+        if column_type == "bool":
+            return values.astype(bool)
+        return values
+
+    def to_file(self, filename: str):
+        dataframe_to_file(self.to_dataframe(), filename)
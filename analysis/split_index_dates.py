@@ -0,0 +1,81 @@
+# Split a cohort extracted for several index dates in one pass into one file
+# per index date
+#
+# Usage (from the project root):
+#   cohortextractor generate_cohort --study-definition study_definition \
+#     --output-format feather --param index_dates=<name>:<date>,<name>:<date>
+#   python analysis/split_index_dates.py --index-dates <name>:<date>,<name>:<date>
+#
+# With the index_dates parameter the study definition evaluates the common
+# variables and the population flags for every index date, suffixed _<name>,
+# alongside the variables that do not depend on the index date (JCVI groups,
+# vaccination and death dates), for everyone in the population at any of the
+# index dates. Each output/input_<name>.feather has the patients in the
+# population at that index date (in_population_<name>), with the shared
+# columns, the variables for that index date under their usual names, and an
+# index_date column, so it can be read exactly like output/input.feather.
+# Date-of-match columns added by cohortextractor (e.g. cov_num_bmi_date_measured)
+# follow the suffixed name, as in cov_num_bmi_<name>_date_measured.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Regular expressions
+import re
+
+## Arrow tables
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+# Files
+
+COHORT_FILE = "output/input.feather"
+
+# Flag of the patients in the population at each index date, before its suffix
+POPULATION_FLAG = "in_population"
+
+
+def split_index_dates(cohort: pa.Table, index_dates: dict) -> dict:
+    """
+    dictionary of index date name: table of the shared columns and the
+    columns for that index date, with their suffix removed, for the patients
+    in the population at that index date
+    """
+    patterns = {
+        name: re.compile(rf"^(.+)_{re.escape(name)}(_date|_date_measured)?$") for name in index_dates
+    }
+    shared = [
+        column for column in cohort.column_names
+        if not any(pattern.match(column) for pattern in patterns.values())
+    ]
+    tables = {}
+    for name, index_date in index_dates.items():
+        table = cohort.select(shared)
+        for column in cohort.column_names:
+            match = patterns[name].match(column)
+            if match:
+                table = table.append_column(match[1] + (match[2] or ""), cohort[column])
+        table = table.append_column(
+            "index_date", pa.array([index_date] * cohort.num_rows).cast(pa.date32())
+        )
+        in_population = pc.cast(table[POPULATION_FLAG], pa.bool_())
+        tables[name] = table.filter(in_population).drop([POPULATION_FLAG])
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-dates", required=True)
+    args = parser.parse_args()
+
+    index_dates = dict(index_date.split(":") for index_date in args.index_dates.split(","))
+    cohort = feather.read_table(COHORT_FILE)
+    for name, table in split_index_dates(cohort, index_dates).items():
+        feather.write_feather(table, f"output/input_{name}.feather")
+
+
+if __name__ == "__main__":
+    main()
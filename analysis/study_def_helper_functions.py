@@ -16,19 +16,39 @@ def generate_ethnicity_dictionary(n_groups: int) -> dict:
     return eth_dict
 
 
+def generate_bin_dictionary(variable: str, edges: list, labels: list, default="0") -> dict:
+    """
+    create dictionary of label: range of `variable` between consecutive
+    `edges` (lower bound included, a last edge of None for no upper bound),
+    to be used with patients.categorised_as(). The local backend evaluates
+    these as bins with a single search over the edges (see binning.py); on
+    TPP they are still a CASE expression with one predicate per bin.
+    """
+    bin_dict = {default: "DEFAULT"}
+    for label, lower, upper in zip(labels, edges, edges[1:]):
+        condition = f"{variable} >= {lower}"
+        if upper is not None:
+            condition += f" AND {variable} < {upper}"
+        bin_dict[label] = condition
+    return bin_dict
+
+
+def generate_ntile_dictionary(variable: str, ntiles: int, maximum: int, minimum=1) -> dict:
+    """
+    create dictionary of n:range of the nth of `ntiles` equal ranges of
+    `variable` from `minimum` to `maximum` (edges rounded down by SQL integer
+    division), to be used with patients.categorised_as().
+    """
+    edges = [minimum] + [f"{maximum}*{n}/{ntiles}" for n in range(1, ntiles)] + [None]
+    return generate_bin_dictionary(variable, edges, [str(n) for n in range(1, ntiles + 1)])
+
+
 def generate_deprivation_ntile_dictionary(ntiles: int) -> dict:
     """
     create dictionary of n:logical defition of ntiles of index of multiple deprivation
     values for arbitrary n, to be used with patients.categorised_as().
     """
-    dep_dict = {"0": "DEFAULT"}
-    for n in range(1, ntiles + 1):
-        l = f"index_of_multiple_deprivation >={1 if n==1 else f'32844*{n-1}/{ntiles}'}"
-        r = f" AND index_of_multiple_deprivation < 32844*{n}/{ntiles}"
-
-        dep_dict[str(n)] = l if n == ntiles else l + r
-
-    return dep_dict
+    return generate_ntile_dictionary("index_of_multiple_deprivation", ntiles, 32844)
 
 
 def generate_universal_expectations(n_categories: int, zero_category=True) -> dict:
@@ -0,0 +1,587 @@
+## Regular expressions
+import re
+
+## Definition hashes
+import hashlib
+
+## Cohort extractor
+from cohortextractor import patients, codelist
+from cohortextractor.date_expressions import (
+    DateExpressionEvaluator,
+    evaluate_date_expressions_in_expectations_definition,
+)
+
+## Codelist contents
+from codelist_index import codelist_codes, prune_prefix_codes
+
+# Arguments that set the window a query looks over
+WINDOW_ARGS = ("on_or_before", "on_or_after", "between")
+
+# Other arguments that take a date
+DATE_ARGS = ("date", "reference_date", "start_date", "end_date")
+
+# Arguments that only affect what is returned from a matching event, not
+# which events are scanned
+RETURN_ARGS = (
+    "returning",
+    "date_format",
+    "find_first_match_in_period",
+    "find_last_match_in_period",
+    "include_date_of_match",
+    "return_expectations",
+)
+
+# Query types that do not scan a source table themselves
+DERIVED_QUERY_TYPES = ("aggregate_of", "categorised_as", "value_from", "fixed_value")
+
+# Query types that can compute their own hidden variables
+NESTING_QUERY_TYPES = ("aggregate_of", "categorised_as")
+
+# Query types that record the date of the first or last match alongside a
+# count of matching events
+TIMELINE_QUERY_TYPES = ("with_these_clinical_events", "with_these_medications")
+
+# Return types of the value of the first or last match, which is always
+# queried together with the date of that match
+VALUE_RETURNS = ("numeric_value", "category", "code")
+
+# Codelist arguments matched by prefix (a codelist entry matches any recorded
+# code that starts with it), by query type
+PREFIX_CODELIST_ARGS = {
+    "admitted_to_hospital": ("with_these_diagnoses", "with_these_primary_diagnoses", "with_these_procedures"),
+}
+
+
+def codelist_key(codelist) -> tuple:
+    """
+    hashable identity of a codelist based on its coding system and contents,
+    so that separately constructed copies (e.g. repeated combine_codelists()
+    calls) are recognised as the same codelist
+    """
+    return (getattr(codelist, "system", None), tuple(sorted(map(str, codelist))))
+
+
+def derived_flag(expression: str, query_args: dict) -> tuple:
+    """
+    binary flag of an expression over other variables, in place of the
+    binary flag with arguments `query_args`; satisfying() is used because
+    cohortextractor generates its dummy data from its own expectations, where
+    minimum_of(), maximum_of() and date_of() take theirs from their sources
+    """
+    return patients.satisfying(
+        expression,
+        return_expectations=dict(query_args.get("return_expectations") or {}),
+    )
+
+
+def keeps_dummy_dates(date_args: dict, source_args: dict) -> bool:
+    """
+    whether a date variable with arguments `date_args` can be taken from
+    another variable with date_of() without changing its dummy data:
+    cohortextractor generates the dates of date_of() from the expectations of
+    its source, and does not restrict them to the date variable's window
+    """
+    return (
+        not any(date_args.get(arg) for arg in WINDOW_ARGS)
+        and date_args.get("return_expectations") == source_args.get("return_expectations")
+    )
+
+
+def scan_key(query_type: str, query_args: dict) -> tuple:
+    """
+    key identifying the (source table, codelist) scan a query performs,
+    ignoring its window and return type
+    """
+    key = []
+    for arg, value in sorted(query_args.items()):
+        if arg in WINDOW_ARGS or arg in RETURN_ARGS:
+            continue
+        if isinstance(value, list) and hasattr(value, "system"):
+            value = codelist_key(value)
+        key.append((arg, repr(value)))
+    return (query_type, tuple(key))
+
+
+def query_window(query_args: dict) -> tuple:
+    """
+    (start, end) window of a query, with None for an open end
+    """
+    if query_args.get("between"):
+        return tuple(query_args["between"])
+    return (query_args.get("on_or_after"), query_args.get("on_or_before"))
+
+
+def return_key(query_args: dict) -> tuple:
+    """
+    key identifying what a query returns from the events in its window
+    """
+    return tuple(
+        repr(query_args.get(arg)) for arg in RETURN_ARGS if arg != "return_expectations"
+    )
+
+
+def plan_shared_scans(variables: dict) -> dict:
+    """
+    group variables by the (source table, codelist) scan they perform,
+    returning a dictionary of scan key: list of variable names
+    """
+    plan = {}
+    for name, (query_type, query_args) in variables.items():
+        if query_type in DERIVED_QUERY_TYPES:
+            continue
+        plan.setdefault(scan_key(query_type, query_args), []).append(name)
+    return plan
+
+
+def variable_references(query_type: str, query_args: dict, names: set) -> set:
+    """
+    names of the variables in `names` that a variable refers to, through
+    column names, source variables, expressions, windows or nested variables
+    """
+    references = set()
+    for arg, value in query_args.items():
+        if arg == "return_expectations":
+            continue
+        if arg == "extra_columns":
+            for nested in value.values():
+                references |= variable_references(*nested, names)
+            continue
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, list) and hasattr(value, "system"):
+            continue
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(item, str):
+                references.update(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", item))
+    return references & names
+
+
+def rename_references(query_type: str, query_args: dict, renames: dict) -> tuple:
+    """
+    copy of a variable definition with the variables it refers to (and any
+    nested variables) renamed according to `renames`
+    """
+    def rename(value):
+        if isinstance(value, str):
+            return re.sub(r"[A-Za-z_][A-Za-z0-9_]*", lambda match: renames.get(match[0], match[0]), value)
+        if isinstance(value, list) and hasattr(value, "system"):
+            return value
+        if isinstance(value, (list, tuple)):
+            return type(value)(rename(item) for item in value)
+        if isinstance(value, dict):
+            return {key: rename(item) for key, item in value.items()}
+        return value
+
+    renamed = {}
+    for arg, value in query_args.items():
+        if arg in RETURN_ARGS:
+            renamed[arg] = value
+        elif arg == "extra_columns":
+            renamed[arg] = {
+                renames.get(name, name): rename_references(*nested, renames)
+                for name, nested in value.items()
+            }
+        else:
+            renamed[arg] = rename(value)
+    return (query_type, renamed)
+
+
+def evaluate_index_date(query_type: str, query_args: dict, index_date: str) -> tuple:
+    """
+    copy of a variable definition (and any nested variables) with date
+    expressions relative to the index date (e.g. "index_date - 1 day")
+    evaluated for `index_date`, as StudyDefinition() does for its own index date
+    """
+    evaluate = DateExpressionEvaluator(index_date)
+
+    def evaluate_date(value):
+        if isinstance(value, str) and re.match(r"\s*index_date\b", value):
+            return evaluate(value)
+        if isinstance(value, (list, tuple)):
+            return type(value)(evaluate_date(item) for item in value)
+        return value
+
+    evaluated = {}
+    for arg, value in query_args.items():
+        if arg in WINDOW_ARGS or arg in DATE_ARGS:
+            evaluated[arg] = evaluate_date(value)
+        elif arg == "return_expectations":
+            evaluated[arg] = evaluate_date_expressions_in_expectations_definition(value, index_date)
+        elif arg == "extra_columns":
+            evaluated[arg] = {
+                name: evaluate_index_date(*nested, index_date) for name, nested in value.items()
+            }
+        else:
+            evaluated[arg] = value
+    return (query_type, evaluated)
+
+
+def nested_names(variables: dict) -> list:
+    """
+    names of variables and of the variables nested inside them
+    """
+    names = []
+    for name, (query_type, query_args) in variables.items():
+        names.extend(nested_names(query_args.get("extra_columns") or {}))
+        names.append(name)
+    return names
+
+
+def for_index_dates(generate, index_dates: dict) -> dict:
+    """
+    evaluate the variables returned by generate(index_date_variable="index_date")
+    for each of several index dates in one study definition, given as a
+    dictionary of name: ISO date; every variable generated for an index date
+    is suffixed _<name>
+    """
+    variables = {}
+    for era, index_date in index_dates.items():
+        era_variables = generate(index_date_variable="index_date")
+        renames = {name: f"{name}_{era}" for name in nested_names(era_variables)}
+        for name, definition in era_variables.items():
+            variables[renames[name]] = evaluate_index_date(
+                *rename_references(*definition, renames), index_date
+            )
+    return variables
+
+
+def dependency_graph(variables: dict) -> dict:
+    """
+    dictionary of variable name: set of the other variables it refers to
+    """
+    names = set(variables)
+    return {
+        name: variable_references(*definition, names) - {name}
+        for name, definition in variables.items()
+    }
+
+
+def order_by_dependencies(variables: dict) -> dict:
+    """
+    reorder variables so that every variable comes after the variables it
+    refers to, otherwise keeping the order they were defined in
+    """
+    graph = dependency_graph(variables)
+    ordered = {}
+    pending = list(variables)
+    while pending:
+        for name in pending:
+            if graph[name] <= ordered.keys():
+                break
+        else:
+            raise ValueError(f"Circular references between variables: {', '.join(pending)}")
+        pending.remove(name)
+        ordered[name] = variables[name]
+    return ordered
+
+
+def flatten_aggregates(variables: dict, prefix="tmp_") -> dict:
+    """
+    replace intermediate columns (named with `prefix`) of minimum_of() or
+    maximum_of() variables that are themselves aggregates with the same
+    function by the columns they aggregate, so chains of nested reductions
+    become a single reduction (e.g. maximum_of(a, tmp_b) with tmp_b =
+    maximum_of(c, d) becomes maximum_of(a, c, d)); the minimum (maximum) of
+    minima (maxima) is the minimum (maximum) of all their values, missing
+    values included
+    """
+    flattened = {}
+
+    def columns(name, function):
+        query_type, query_args = flattened.get(name, (None, {}))
+        if (
+            name.startswith(prefix)
+            and query_type == "aggregate_of"
+            and query_args["aggregate_function"] == function
+        ):
+            return query_args["column_names"]
+        return [name]
+
+    for name, (query_type, query_args) in order_by_dependencies(variables).items():
+        if query_type == "aggregate_of":
+            function = query_args["aggregate_function"]
+            column_names = []
+            for column in query_args["column_names"]:
+                column_names.extend(c for c in columns(column, function) if c not in column_names)
+            query_args = dict(query_args, column_names=column_names)
+        flattened[name] = (query_type, query_args)
+    return {name: flattened[name] for name in variables}
+
+
+def hide_intermediates(variables: dict, keep=(), prefix="tmp_") -> dict:
+    """
+    nest intermediate variables (named with `prefix`) inside the variable
+    that uses them, so they are still computed but are hidden from the output
+    file; intermediates whose names start with one of `keep` are left in the
+    output, as are derived intermediates and those used by more than one
+    variable or by a variable that cannot nest them (cohortextractor can only
+    generate dummy data for hidden columns queried directly by a single host);
+    intermediates that no variable uses are dropped
+    """
+    variables = order_by_dependencies(variables)
+    graph = dependency_graph(variables)
+    keep = tuple(keep)
+
+    consumers = {}
+    for name in variables:
+        for dependency in graph[name]:
+            consumers.setdefault(dependency, []).append(name)
+
+    unused = {
+        name for name in variables
+        if name.startswith(prefix) and not name.startswith(keep) and name not in consumers
+    }
+
+    hosts = {}
+    for dependency, names in consumers.items():
+        if (
+            len(names) == 1
+            and dependency.startswith(prefix)
+            and variables[dependency][0] not in DERIVED_QUERY_TYPES
+            and not dependency.startswith(keep)
+            and variables[names[0]][0] in NESTING_QUERY_TYPES
+        ):
+            hosts[dependency] = names[0]
+
+    def nest(name):
+        query_type, query_args = variables[name]
+        nested = {dependency: nest(dependency) for dependency in variables if hosts.get(dependency) == name}
+        if nested:
+            query_args = dict(query_args, extra_columns=dict(query_args["extra_columns"], **nested))
+        return (query_type, query_args)
+
+    return {name: nest(name) for name in variables if name not in hosts and name not in unused}
+
+
+def definition_key(query_type: str, query_args: dict) -> tuple:
+    """
+    canonical representation of a variable definition, with codelists
+    resolved to their contents and nested variables to their own definitions
+    """
+    key = []
+    for arg, value in sorted(query_args.items()):
+        if arg == "extra_columns":
+            value = tuple((name, definition_key(*nested)) for name, nested in sorted(value.items()))
+        elif isinstance(value, list) and hasattr(value, "system"):
+            value = codelist_key(value)
+        key.append((arg, repr(value)))
+    return (query_type, tuple(key))
+
+
+def definition_hashes(variables: dict) -> dict:
+    """
+    dictionary of variable name: hash of its definition and of the
+    definitions of the variables it refers to, so a variable's hash changes
+    whenever its own definition, codelist or window changes or any variable
+    it depends on changes
+    """
+    variables = order_by_dependencies(variables)
+    graph = dependency_graph(variables)
+    hashes = {}
+    for name, definition in variables.items():
+        key = (definition_key(*definition), tuple((dependency, hashes[dependency]) for dependency in sorted(graph[name])))
+        hashes[name] = hashlib.sha256(repr(key).encode()).hexdigest()
+    return hashes
+
+
+def changed_variables(variables: dict, previous: dict) -> dict:
+    """
+    variables whose definition hash differs from `previous` (including
+    variables that depend on a changed variable), together with the
+    variables they refer to, which are needed to compute them
+    """
+    variables = order_by_dependencies(variables)
+    graph = dependency_graph(variables)
+    hashes = definition_hashes(variables)
+
+    needed = set()
+    pending = [name for name in variables if previous.get(name) != hashes[name]]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(graph[name])
+    return {name: definition for name, definition in variables.items() if name in needed}
+
+
+def prune_prefix_codelists(variables: dict) -> dict:
+    """
+    remove the codes of prefix-matched codelists (hospital diagnoses and
+    procedures) that start with another code in the same codelist, as each
+    code becomes a separate LIKE pattern in the query but matches no more
+    admissions than its shorter prefix (e.g. I210 when I21 is also listed)
+    """
+    pruned = {}
+
+    def prune(value):
+        key = codelist_key(value)
+        if key not in pruned:
+            pruned[key] = codelist(prune_prefix_codes(codelist_codes(value)), value.system)
+        return pruned[key]
+
+    result = {}
+    for name, (query_type, query_args) in variables.items():
+        args = [
+            arg for arg in PREFIX_CODELIST_ARGS.get(query_type, ())
+            if query_args.get(arg) and not query_args[arg].has_categories
+        ]
+        if args:
+            query_args = dict(query_args, **{arg: prune(query_args[arg]) for arg in args})
+        result[name] = (query_type, query_args)
+    return result
+
+
+def share_event_timeline(variables: dict, names: list) -> dict:
+    """
+    answer variables over the same event window from a single query:
+    a count of matching events also records the date of the first (or last)
+    match, so date variables are taken from the count with date_of() (where
+    that keeps their dummy data, see keeps_dummy_dates()) and binary flags
+    are taken from whether the count (or date) is set
+    """
+    counts = [name for name in names if variables[name][1].get("returning") == "number_of_matches_in_period"]
+    dates = [name for name in names if variables[name][1].get("returning") == "date"]
+    flags = [name for name in names if variables[name][1].get("returning") == "binary_flag"]
+
+    timeline = {}
+    if counts:
+        anchor = counts[0]
+        query_type, query_args = variables[anchor]
+        for name in dates:
+            date_args = variables[name][1]
+            if not keeps_dummy_dates(date_args, query_args):
+                continue
+            matching = {
+                arg: date_args.get(arg)
+                for arg in ("find_first_match_in_period", "find_last_match_in_period")
+            }
+            if anchor not in timeline:
+                timeline[anchor] = (query_type, dict(query_args, **matching))
+            elif any(timeline[anchor][1].get(arg) != value for arg, value in matching.items()):
+                continue
+            timeline[name] = patients.date_of(
+                anchor,
+                date_format=date_args.get("date_format"),
+                return_expectations=date_args.get("return_expectations"),
+            )
+    elif dates:
+        anchor = dates[0]
+    else:
+        return timeline
+
+    for name in flags:
+        timeline[name] = derived_flag(anchor, variables[name][1])
+    return timeline
+
+
+def share_matched_values(variables: dict, names: list) -> dict:
+    """
+    take date variables from a variable returning the value (numeric value,
+    category or code) of the same first or last match over the same window,
+    with date_of(), as the query for the value also returns its date (where
+    that keeps their dummy data, see keeps_dummy_dates())
+    """
+    def match_key(query_args):
+        return (query_window(query_args), bool(query_args.get("find_first_match_in_period")))
+
+    values = {}
+    for name in names:
+        query_args = variables[name][1]
+        if query_args.get("returning") in VALUE_RETURNS:
+            values.setdefault(match_key(query_args), name)
+
+    shared = {}
+    for name in names:
+        query_args = variables[name][1]
+        source = values.get(match_key(query_args))
+        if (
+            query_args.get("returning") == "date"
+            and source
+            and not query_args.get("include_date_of_match")
+            and keeps_dummy_dates(query_args, variables[source][1])
+        ):
+            shared[name] = patients.date_of(
+                source,
+                date_format=query_args.get("date_format"),
+                return_expectations=query_args.get("return_expectations"),
+            )
+    return shared
+
+
+def fuse_shared_scans(variables: dict) -> dict:
+    """
+    derive variables from other variables scanning the same table and
+    codelist, so each distinct scan is only run once:
+    - binary flags duplicating another binary flag are taken from the first
+      one defined
+    - binary flags over a window that is split exactly by two other binary
+      flags (e.g. ever = history OR recent) are satisfied by either flag
+    - dates of the first or last match over the same window as a variable
+      returning that match's value are taken from it (see
+      share_matched_values())
+    - counts, dates and binary flags of clinical events or medications over
+      the same window share one query (see share_event_timeline())
+    fused variables are moved to after the variables they are derived from
+    """
+    fused = {}
+    for names in plan_shared_scans(variables).values():
+        if len(names) < 2:
+            continue
+
+        windows = {}
+        for name in names:
+            query_args = variables[name][1]
+            key = (query_window(query_args), return_key(query_args))
+            if key in windows and query_args.get("returning") == "binary_flag":
+                fused[name] = derived_flag(windows[key], query_args)
+            elif key not in windows:
+                windows[key] = name
+
+        flags = {
+            window: name
+            for (window, returned), name in windows.items()
+            if variables[name][1].get("returning") == "binary_flag"
+            and not variables[name][1].get("include_date_of_match")
+        }
+        for (start, end), name in flags.items():
+            if start is not None:
+                continue
+            for (split_start, split_end), recent in flags.items():
+                history = flags.get((None, split_start))
+                if (
+                    split_end == end
+                    and split_start is not None
+                    and history is not None
+                    and history != name
+                ):
+                    fused[name] = derived_flag(f"{recent} OR {history}", variables[name][1])
+                    break
+
+        if variables[names[0]][0] not in TIMELINE_QUERY_TYPES:
+            continue
+        fused.update(share_matched_values(variables, [name for name in windows.values() if name not in fused]))
+        timelines = {}
+        for name in windows.values():
+            if name not in fused and not variables[name][1].get("include_date_of_match"):
+                timelines.setdefault(query_window(variables[name][1]), []).append(name)
+        for timeline in timelines.values():
+            fused.update(share_event_timeline(variables, timeline))
+
+    return order_by_dependencies({name: fused.get(name, definition) for name, definition in variables.items()})
+
+
+def fuse_nested_scans(variables: dict) -> dict:
+    """
+    fuse_shared_scans() over variables and, within each variable that nests
+    others (e.g. the satisfying() blocks of the JCVI groups), over the
+    variables it nests
+    """
+    def fuse_nested(definition):
+        query_type, query_args = definition
+        nested = query_args.get("extra_columns")
+        if not nested:
+            return definition
+        nested = fuse_shared_scans({name: fuse_nested(definition) for name, definition in nested.items()})
+        return (query_type, dict(query_args, extra_columns=nested))
+
+    return fuse_shared_scans({name: fuse_nested(definition) for name, definition in variables.items()})
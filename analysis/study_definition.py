@@ -12,6 +12,7 @@ from cohortextractor import (
   codelist,
   filter_codes_by_category,
   combine_codelists,
+  params,
 )
 
 ## Codelists from codelist.py (which pulls them from the codelist folder)
@@ -20,14 +21,92 @@ from codelists import *
 ## Datetime functions
 from datetime import date
 
+## Variable definition hashes
+import json
+
 ## Study definition helper
 import study_def_helper_functions as helpers
 
+## Study definition planner
+import study_def_planner as planner
+
 ## Import common variables function
 from common_variables import generate_common_variables
-(
-    dynamic_variables
-) = generate_common_variables(index_date_variable="index_date")
+
+## Study population: alive, registered and with 6 months of follow-up at the index date
+def generate_population_variables(index_date_variable):
+    population_variables = dict(
+        in_population = patients.satisfying(
+            """
+                NOT has_died
+                AND
+                registered        
+                AND
+                has_follow_up_previous_6months
+                """,
+            
+            has_died = patients.died_from_any_cause(
+            on_or_before = f"{index_date_variable}",
+            returning="binary_flag",
+            ),
+            
+            registered = patients.satisfying(
+            "registered_at_start",
+            registered_at_start = patients.registered_as_of(f"{index_date_variable}"),
+            ),
+            
+            has_follow_up_previous_6months = patients.registered_with_one_practice_between(
+            start_date = f"{index_date_variable} - 6 months",
+            end_date = f"{index_date_variable}",
+            return_expectations = {"incidence": 0.95},
+            ),
+        ),
+    )
+    return population_variables
+
+## Evaluate the common variables for several index dates in one extraction with
+## --param index_dates=<name>:<date>,<name>:<date> (see split_index_dates.py);
+## the population is then everyone in the population at any of the index dates,
+## with in_population_<name> flagging those in it at each one
+if "index_dates" in params:
+    index_dates = dict(index_date.split(":") for index_date in params["index_dates"].split(","))
+    dynamic_variables = planner.for_index_dates(generate_common_variables, index_dates)
+    population_variables = planner.for_index_dates(generate_population_variables, index_dates)
+    population = patients.satisfying(" OR ".join(population_variables))
+else:
+    dynamic_variables = generate_common_variables(index_date_variable="index_date")
+    population_variables = {}
+    population = generate_population_variables(index_date_variable="index_date")["in_population"]
+
+## Apply the planner's rewrites below unless --param unplanned=1, which extracts
+## the variables as written (see check_planner.py)
+planned = "unplanned" not in params
+
+if planned:
+    ## Match hospital diagnoses against codelists with redundant codes removed
+    ## (codes that start with another code in the same codelist)
+    dynamic_variables = planner.prune_prefix_codelists(dynamic_variables)
+
+    ## Share scans between variables querying the same table and codelist
+    dynamic_variables = planner.fuse_shared_scans(dynamic_variables)
+
+    ## Reduce chains of minimum_of/maximum_of to single reductions over their source columns
+    dynamic_variables = planner.flatten_aggregates(dynamic_variables)
+
+    ## Hide tmp_ variables from the output, other than those used after extraction
+    ## (diabetes algorithm, cholesterol ratio and Venn diagrams)
+    dynamic_variables = planner.hide_intermediates(
+        dynamic_variables,
+        keep=["tmp_out_", "tmp_cov_num_"],
+    )
+
+## Hash variable definitions before StudyDefinition() adds its own arguments to them,
+## and only extract variables whose definitions have changed since the extraction
+## recorded in --param changed_since=<hashes file> (see extract_changed_variables.py)
+variable_hashes = planner.definition_hashes(dynamic_variables)
+if "changed_since" in params:
+    with open(params["changed_since"]) as f:
+        dynamic_variables = planner.changed_variables(dynamic_variables, json.load(f))
 
 ## Variables for deriving JCVI groups
 from grouping_variables import (
@@ -36,6 +115,10 @@ from grouping_variables import (
     end_date,
 )
 
+## Share scans between JCVI variables, including those nested in the satisfying() blocks
+if planned:
+    jcvi_variables = planner.fuse_nested_scans(jcvi_variables)
+
 study = StudyDefinition(
 
     # Specify index date for study
@@ -50,31 +133,8 @@ study = StudyDefinition(
 
     # Define the study population 
     # NB: not all inclusions and exclusions are written into study definition
-    population = patients.satisfying(
-        """
-            NOT has_died
-            AND
-            registered        
-            AND
-            has_follow_up_previous_6months
-            """,
-        
-        has_died = patients.died_from_any_cause(
-        on_or_before = "index_date",
-        returning="binary_flag",
-        ),
-        
-        registered = patients.satisfying(
-        "registered_at_start",
-        registered_at_start = patients.registered_as_of("index_date"),
-        ),
-        
-        has_follow_up_previous_6months = patients.registered_with_one_practice_between(
-        start_date = "index_date - 6 months",
-        end_date = "index_date",
-        return_expectations = {"incidence": 0.95},
-        ),
-    ),
+    population = population,
+    **population_variables,
 
     # Define quality assurances
 
@@ -202,4 +262,4 @@ study = StudyDefinition(
     # Define common variables (e.g., exposures, outcomes, covariates) that require dynamic dates
 
         **dynamic_variables
-)
\ No newline at end of file
+)
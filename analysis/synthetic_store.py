@@ -0,0 +1,369 @@
+# Generate a local event-level synthetic EHR store for running the study
+# definition end to end (see extract_local.py)
+#
+# Usage (from the project root):
+#   python analysis/synthetic_store.py --patients N [--store PATH] [--seed S]
+#
+# The store is a SQLite file with one table per source the study queries:
+# patients, practice registrations, addresses, clinical events, medications,
+# hospital admissions (APC spells), ONS deaths, SGSS tests, vaccinations and GP
+# consultations (see SCHEMA). Its layout follows the TPP tables the backend
+# queries, reduced to the columns this study uses, with dates stored as ISO
+# strings and current registrations ending on 9999-12-31 as in TPP.
+#
+# Coded events are sampled from the codelists (codelists/*.csv) the study
+# definition queries each table with, so every variable matches some events,
+# mixed with random codes of the same systems (NOISE_FRACTION). 3-character
+# ICD-10 codes are usually recorded as one of their 4-character codes, as in
+# HES. Patients are generated in chunks of CHUNK_SIZE with an independent
+# random stream per chunk, so memory stays flat from 1M to 50M patients.
+
+# Import statements
+
+## Command line arguments
+import argparse
+
+## Database and paths
+import os
+import sqlite3
+
+## Arrays
+import numpy as np
+
+## Cohort extractor
+from cohortextractor.cohortextractor import load_study_definition
+
+## Codelist contents
+from codelist_index import codelist_codes
+
+# Files
+
+STORE_FILE = "output/synthetic_ehr.sqlite"
+
+# Patients generated (and inserted) at a time
+CHUNK_SIZE = 100000
+
+# Diagnosis positions of an APC spell, and cause of death positions of an ONS
+# death registration
+DIAGNOSIS_POSITIONS = 20
+CAUSE_POSITIONS = 15
+
+SCHEMA = {
+    "patient": ["patient_id INTEGER PRIMARY KEY", "date_of_birth TEXT", "sex TEXT", "date_of_death TEXT"],
+    "registration": ["patient_id INTEGER", "start_date TEXT", "end_date TEXT", "region TEXT"],
+    "address": ["patient_id INTEGER", "start_date TEXT", "end_date TEXT", "imd INTEGER", "care_home TEXT"],
+    "clinical_event": ["patient_id INTEGER", "date TEXT", "system TEXT", "code TEXT", "value REAL"],
+    "medication": ["patient_id INTEGER", "date TEXT", "code TEXT"],
+    "apcs": (
+        ["patient_id INTEGER", "admission_date TEXT", "ethnic_group TEXT", "primary_diagnosis TEXT"]
+        + [f"diagnosis_{i:02d} TEXT" for i in range(1, DIAGNOSIS_POSITIONS + 1)]
+    ),
+    "ons_death": (
+        ["patient_id INTEGER", "date TEXT", "underlying_cause TEXT"]
+        + [f"cause_{i:02d} TEXT" for i in range(1, CAUSE_POSITIONS + 1)]
+    ),
+    "sgss_test": ["patient_id INTEGER", "specimen_date TEXT", "result TEXT"],
+    "vaccination": ["patient_id INTEGER", "date TEXT", "target_disease TEXT", "healthcare_worker INTEGER"],
+    "gp_consultation": ["patient_id INTEGER", "date TEXT"],
+}
+
+# Table each coded query reads, and the arguments holding its codelists
+CODED_QUERIES = {
+    "with_these_clinical_events": ("clinical_event", ["codelist"]),
+    "max_recorded_value": ("clinical_event", ["codelist"]),
+    "with_these_medications": ("medication", ["codelist"]),
+    "admitted_to_hospital": ("apcs", ["with_these_diagnoses", "with_these_primary_diagnoses"]),
+    "with_these_codes_on_death_certificate": ("ons_death", ["codelist"]),
+}
+
+# Events per patient (Poisson means)
+RATES = {
+    "clinical_event": 40,
+    "medication": 15,
+    "apcs": 0.4,
+    "sgss_test": 0.6,
+    "gp_consultation": 6,
+}
+
+# Share of coded events with a code that is in none of the study's codelists
+NOISE_FRACTION = 0.5
+
+# Date range of events
+EVENTS_START = "2000-01-01"
+EVENTS_END = "2022-12-31"
+
+# TPP code for a recorded BMI (see most_recent_bmi)
+BMI_CODE = "22K.."
+
+REGIONS = [
+    "North East", "North West", "Yorkshire and The Humber", "East Midlands",
+    "West Midlands", "East", "London", "South East", "South West",
+]
+
+# Highest index of multiple deprivation (number of LSOAs in England)
+MAX_IMD = 32844
+
+
+def table_codelists(covariate_definitions: dict) -> dict:
+    """
+    dictionary of table: list of the codelists the study queries it with,
+    including those of nested variables
+    """
+    tables = {}
+    for query_type, query_args in covariate_definitions.values():
+        if query_type in CODED_QUERIES:
+            table, args = CODED_QUERIES[query_type]
+            for arg in args:
+                if query_args.get(arg):
+                    tables.setdefault(table, []).append(query_args[arg])
+        if query_args.get("extra_columns"):
+            for table, codelists in table_codelists(query_args["extra_columns"]).items():
+                tables.setdefault(table, []).extend(codelists)
+    return tables
+
+
+class CodePool:
+    """
+    codes (and their coding systems) to sample events from, weighted so that
+    each codelist is equally likely whatever its size
+    """
+
+    def __init__(self, codelists: list):
+        codes, systems, weights = [], [], []
+        for codelist in codelists:
+            members = sorted(codelist_codes(codelist))
+            codes.extend(members)
+            systems.extend([codelist.system] * len(members))
+            weights.extend([1 / len(members)] * len(members))
+        self.codes = np.array(codes, dtype=object)
+        self.systems = np.array(systems, dtype=object)
+        self.weights = np.array(weights) / max(sum(weights), 1)
+        self.value_codes = set()
+
+    def sample(self, rng, size: int) -> tuple:
+        """
+        codes and coding systems of `size` events
+        """
+        if len(self.codes) == 0:
+            return np.full(size, "", dtype=object), np.full(size, "", dtype=object)
+        chosen = rng.choice(len(self.codes), size=size, p=self.weights)
+        return self.codes[chosen], self.systems[chosen]
+
+
+def noise_codes(rng, size: int, systems: np.ndarray) -> np.ndarray:
+    """
+    random codes of the given coding systems, in the format of each system
+    (random ICD-10 codes may happen to be in a codelist; the others are not)
+    """
+    digits = rng.integers(0, 10**9, size=size).astype(str)
+    letters = np.array(list("ABCDEFGHJKLMNPQRSTUVWXYZ"), dtype=object)[rng.integers(0, 24, size=size)]
+    codes = np.char.add("9", np.char.zfill(digits, 9)).astype(object)
+    ctv3 = systems == "ctv3"
+    codes[ctv3] = np.char.add("Z", np.char.zfill(digits[ctv3], 9).astype("U4")).astype(object)
+    icd10 = systems == "icd10"
+    codes[icd10] = letters[icd10] + np.char.zfill(digits[icd10], 9).astype("U3").astype(object)
+    return codes
+
+
+def recorded_icd10(rng, codes: np.ndarray) -> np.ndarray:
+    """
+    ICD-10 codes as recorded in HES, where most 3-character categories are
+    recorded as one of their 4-character codes
+    """
+    codes = codes.copy()
+    extend = (np.array([len(code) for code in codes]) == 3) & (rng.random(len(codes)) < 0.8)
+    codes[extend] = codes[extend] + rng.integers(0, 10, size=extend.sum()).astype(str).astype(object)
+    return codes
+
+
+def iso_dates(days: np.ndarray) -> np.ndarray:
+    """
+    ISO date strings of days since 1970-01-01
+    """
+    return np.datetime_as_string(days.astype("datetime64[D]")).astype(object)
+
+
+def uniform_dates(rng, start, end) -> np.ndarray:
+    """
+    days (since 1970-01-01) uniformly distributed between per-event `start`
+    and `end` days
+    """
+    start, end = np.broadcast_arrays(start, end)
+    end = np.maximum(start, end)
+    return start + (rng.random(len(start)) * (end - start + 1)).astype(np.int64)
+
+
+def day(date: str) -> int:
+    return int(np.datetime64(date, "D").astype(np.int64))
+
+
+def generate_chunk(rng, first_id: int, size: int, pools: dict) -> dict:
+    """
+    rows of every table for patients `first_id` to `first_id + size - 1`,
+    as a dictionary of table: list of columns
+    """
+    patient_id = np.arange(first_id, first_id + size)
+    today = day(EVENTS_END)
+
+    # Patients: ages roughly uniform up to 100, born on the first of a month
+    birth = today - rng.integers(0, 100 * 365, size=size)
+    birth = birth.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    sex = np.array(["F", "M", "I", "U"], dtype=object)[
+        rng.choice(4, size=size, p=[0.495, 0.495, 0.005, 0.005])
+    ]
+    dies = rng.random(size) < 0.03
+    death = np.where(dies, uniform_dates(rng, np.maximum(birth, day("2019-06-01")), today), 0)
+    primary_care_death = np.where(dies & (rng.random(size) < 0.9), iso_dates(death), None)
+    tables = {"patient": [patient_id, iso_dates(birth), sex, primary_care_death]}
+
+    # Registrations, mostly current, and one address each
+    start = uniform_dates(rng, np.maximum(birth, day("1990-01-01")), day("2020-06-30"))
+    ended = rng.random(size) < 0.1
+    end = np.where(ended, iso_dates(uniform_dates(rng, start, today)), "9999-12-31")
+    region = np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), size=size)]
+    tables["registration"] = [patient_id, iso_dates(start), end, region]
+    care_home = np.array(["", "care_home", "nursing_home"], dtype=object)[
+        rng.choice(3, size=size, p=[0.98, 0.01, 0.01])
+    ]
+    tables["address"] = [
+        patient_id, iso_dates(start), np.full(size, "9999-12-31", dtype=object),
+        rng.integers(0, MAX_IMD + 1, size=size), care_home,
+    ]
+
+    def events(rate):
+        counts = rng.poisson(rate, size=size)
+        ids = np.repeat(patient_id, counts)
+        dates = uniform_dates(
+            rng, np.maximum(np.repeat(birth, counts), day(EVENTS_START)), np.repeat(np.where(dies, death, today), counts)
+        )
+        return ids, dates
+
+    def coded(table, n):
+        codes, systems = pools[table].sample(rng, n)
+        noise = rng.random(n) < NOISE_FRACTION
+        if len(pools[table].codes) == 0:
+            noise[:] = True
+            systems = np.full(n, "icd10" if table in ("apcs", "ons_death") else "snomed", dtype=object)
+        codes[noise] = noise_codes(rng, noise.sum(), systems[noise])
+        return codes, systems
+
+    # Clinical events, with numeric values for the codes that record one
+    ids, dates = events(RATES["clinical_event"])
+    codes, systems = coded("clinical_event", len(ids))
+    bmi = rng.random(len(ids)) < 0.02
+    codes[bmi], systems[bmi] = BMI_CODE, "ctv3"
+    value = np.where(
+        np.isin(codes, list(pools["clinical_event"].value_codes)),
+        np.round(rng.lognormal(np.log(20), 0.8, size=len(ids)), 1),
+        0.0,
+    )
+    value[bmi] = np.round(rng.normal(27, 6, size=bmi.sum()).clip(12, 70), 1)
+    tables["clinical_event"] = [ids, iso_dates(dates), systems, codes, value]
+
+    ids, dates = events(RATES["medication"])
+    tables["medication"] = [ids, iso_dates(dates), coded("medication", len(ids))[0]]
+
+    # Hospital admissions, each with one or more diagnoses
+    ids, dates = events(RATES["apcs"])
+    n = len(ids)
+    positions = np.minimum(1 + rng.poisson(2, size=n), DIAGNOSIS_POSITIONS)
+    diagnoses = np.full((n, DIAGNOSIS_POSITIONS), None, dtype=object)
+    used = np.arange(DIAGNOSIS_POSITIONS)[None, :] < positions[:, None]
+    diagnoses[used] = recorded_icd10(rng, coded("apcs", used.sum())[0])
+    ethnic_group = np.array(list("ABCDEFGHJKLMNPRSZ") + [None], dtype=object)[rng.integers(0, 18, size=n)]
+    tables["apcs"] = [ids, iso_dates(dates), ethnic_group, diagnoses[:, 0]] + list(diagnoses.T)
+
+    # ONS death registrations for the patients who died
+    ids = patient_id[dies]
+    n = len(ids)
+    causes = np.full((n, CAUSE_POSITIONS), None, dtype=object)
+    used = np.arange(CAUSE_POSITIONS)[None, :] < rng.integers(1, 6, size=n)[:, None]
+    causes[used] = coded("ons_death", used.sum())[0]
+    tables["ons_death"] = [ids, iso_dates(death[dies]), causes[:, 0]] + list(causes.T)
+
+    # SARS-CoV-2 tests, vaccinations and GP consultations
+    counts = rng.poisson(RATES["sgss_test"], size=size)
+    ids = np.repeat(patient_id, counts)
+    dates = uniform_dates(rng, np.full(len(ids), day("2020-02-01")), day("2022-06-30"))
+    result = np.where(rng.random(len(ids)) < 0.3, "positive", "negative").astype(object)
+    tables["sgss_test"] = [ids, iso_dates(dates), result]
+
+    adult = (day("2021-07-31") - birth) >= 16 * 365
+    doses = np.where(adult & (rng.random(size) < 0.75), rng.integers(1, 4, size=size), 0)
+    ids = np.repeat(patient_id, doses)
+    first = np.repeat(uniform_dates(rng, np.full(size, day("2020-12-08")), day("2021-07-31")), doses)
+    dose = np.arange(len(ids)) - np.repeat(np.cumsum(doses) - doses, doses)
+    hcw = np.repeat((rng.random(size) < 0.03).astype(int), doses)
+    tables["vaccination"] = [
+        ids, iso_dates(first + dose * 77), np.full(len(ids), "SARS-2 CORONAVIRUS", dtype=object), hcw,
+    ]
+
+    ids, dates = events(RATES["gp_consultation"])
+    tables["gp_consultation"] = [ids, iso_dates(dates)]
+    return tables
+
+
+def create_store(path: str):
+    """
+    create an empty store, replacing any existing one
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    for table, columns in SCHEMA.items():
+        connection.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+    return connection
+
+
+def insert_rows(connection, table: str, columns: list):
+    """
+    insert columns of numpy values into a table
+    """
+    placeholders = ", ".join("?" * len(columns))
+    rows = zip(*(column.tolist() for column in columns))
+    connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+
+
+def generate_store(path: str, patients: int, covariate_definitions: dict, seed=123456, chunk_size=CHUNK_SIZE):
+    """
+    write a synthetic store of `patients` patients with codes sampled from
+    the codelists of the study's variables
+    """
+    codelists = table_codelists(covariate_definitions)
+    pools = {table: CodePool(codelists.get(table, [])) for table in ("clinical_event", "medication", "apcs", "ons_death")}
+    for query_type, query_args in covariate_definitions.values():
+        if query_type == "max_recorded_value":
+            pools["clinical_event"].value_codes |= codelist_codes(query_args["codelist"])
+
+    connection = create_store(path)
+    seeds = np.random.SeedSequence(seed).spawn((patients + chunk_size - 1) // chunk_size)
+    for chunk, first_id in enumerate(range(1, patients + 1, chunk_size)):
+        size = min(chunk_size, patients + 1 - first_id)
+        rng = np.random.default_rng(seeds[chunk])
+        for table, columns in generate_chunk(rng, first_id, size, pools).items():
+            insert_rows(connection, table, columns)
+        connection.commit()
+    for table in SCHEMA:
+        if table != "patient":
+            connection.execute(f"CREATE INDEX {table}_patient_id ON {table} (patient_id)")
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, required=True)
+    parser.add_argument("--store", default=STORE_FILE)
+    parser.add_argument("--seed", type=int, default=123456)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    study = load_study_definition("study_definition")
+    generate_store(args.store, args.patients, study.covariate_definitions, args.seed, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
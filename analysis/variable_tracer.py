@@ -0,0 +1,128 @@
+# Opt-in per-variable profiling of an extraction with LocalBackend
+#
+# Usage (from the project root):
+#   python analysis/extract_local.py --trace
+#
+# A VariableTracer passed to LocalBackend records, for every variable and
+# summed over the chunks of patients:
+#   query_seconds        time spent evaluating the variable's query
+#   materialise_seconds  time spent turning the result into its output column
+#                        (date truncation, population filter, output type)
+#   rows_touched         rows of the source tables the query read (patients
+#                        for variables derived from other variables)
+#   output_bytes         size of the evaluated column
+# Reading each table for a chunk and matching its codes against every codelist
+# (see local_backend.py) is shared by all the variables that query the table,
+# so it is recorded as a scan of the table rather than charged to whichever
+# variable happens to read the table first:
+#   query_seconds        time spent reading and classifying the table
+#   rows_touched         rows read from the table
+# The stats are written to TRACE_TABLE, sorted by total time (scans have the
+# table as their source and "scan" as their variable), and to TRACE_FOLDED as
+# folded stacks (source file;variable;stage or table;scan, then microseconds)
+# that flamegraph.pl or speedscope can render.
+
+# Import statements
+
+## Files
+import os
+
+## Data frames
+import pandas as pd
+
+## Study definition planning
+from study_def_planner import nested_names
+
+# Files
+
+TRACE_TABLE = "logs/variable_trace.tsv"
+TRACE_FOLDED = "logs/variable_trace.folded"
+
+STATS = ("query_seconds", "materialise_seconds", "rows_touched", "output_bytes")
+
+
+def variable_sources(study_module) -> dict:
+    """
+    dictionary of variable name: file that defines it, for the variables of
+    the study definition module
+    """
+    sources = {name: "common_variables.py" for name in nested_names(study_module.dynamic_variables)}
+    sources.update({name: "grouping_variables.py" for name in nested_names(study_module.jcvi_variables)})
+    return sources
+
+
+def column_bytes(values) -> int:
+    """
+    size of an evaluated column, including the strings of object columns
+    """
+    if getattr(values, "dtype", None) == object:
+        return int(pd.Series(values).memory_usage(index=False, deep=True))
+    return int(values.nbytes)
+
+
+class VariableTracer:
+    """
+    query and materialisation time, rows touched and bytes of each variable,
+    and the time and rows of each table scan, summed over the chunks of an
+    extraction
+    """
+
+    def __init__(self, sources: dict):
+        self.sources = sources
+        self.stats = {}
+        self.scans = {}
+
+    def record(self, name: str, **stats):
+        totals = self.stats.setdefault(name, dict.fromkeys(STATS, 0))
+        for stat, value in stats.items():
+            totals[stat] += value
+
+    def record_scan(self, table: str, seconds: float, rows: int):
+        totals = self.scans.setdefault(table, {"seconds": 0.0, "rows": 0})
+        totals["seconds"] += seconds
+        totals["rows"] += rows
+
+    def table(self) -> pd.DataFrame:
+        """
+        the recorded stats, one row per variable and one per table scan, most
+        expensive first
+        """
+        df = pd.DataFrame.from_dict(self.stats, orient="index", columns=list(STATS))
+        df.insert(0, "source", [self.sources.get(name, "study_definition.py") for name in df.index])
+        scans = pd.DataFrame(
+            {
+                "source": list(self.scans),
+                "query_seconds": [scan["seconds"] for scan in self.scans.values()],
+                "materialise_seconds": 0.0,
+                "rows_touched": [scan["rows"] for scan in self.scans.values()],
+                "output_bytes": 0,
+            },
+            index=["scan"] * len(self.scans),
+        )
+        df = pd.concat([df, scans])
+        df.index.name = "variable"
+        df.insert(1, "total_seconds", df["query_seconds"] + df["materialise_seconds"])
+        return df.sort_values("total_seconds", ascending=False)
+
+    def folded(self) -> list:
+        """
+        the recorded times as folded stacks with a count of microseconds
+        """
+        lines = []
+        for name, stats in self.stats.items():
+            for stage in ("query", "materialise"):
+                microseconds = round(stats[f"{stage}_seconds"] * 1e6)
+                if microseconds > 0:
+                    lines.append(f"{self.sources.get(name, 'study_definition.py')};{name};{stage} {microseconds}")
+        for table, scan in self.scans.items():
+            microseconds = round(scan["seconds"] * 1e6)
+            if microseconds > 0:
+                lines.append(f"{table};scan {microseconds}")
+        return lines
+
+    def write(self, table_file=TRACE_TABLE, folded_file=TRACE_FOLDED):
+        os.makedirs(os.path.dirname(table_file), exist_ok=True)
+        self.table().round(6).to_csv(table_file, sep="\t")
+        os.makedirs(os.path.dirname(folded_file), exist_ok=True)
+        with open(folded_file, "w") as f:
+            f.write("\n".join(self.folded()) + "\n")